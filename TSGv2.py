@@ -2,10 +2,16 @@ import os
 import pandas as pd
 import datetime
 import pathlib
+from collections import defaultdict
 from timeit import default_timer as timer
 from config import temp_path, perm_path # type: ignore
+from TSGv3 import timestamps_ns         # type: ignore
+from load_data import SIGNAL_DTYPE      # type: ignore
+import instrumentation                  # type: ignore
+from instrumentation import stage, message  # type: ignore
 import argparse
 
+@stage('TSG')
 def TSG(patient, date, shift, batch, CRhrs, folder):
     """
     Generates the time-stamps for a full batch of EMG-ACM recordings acquired with the Cometa system 
@@ -31,86 +37,93 @@ def TSG(patient, date, shift, batch, CRhrs, folder):
     """ 
     start_timer = timer()
 
-    print("-------------------------------------")
-    print("           PROCESS STARTED           ")
-    print("-------------------------------------")
+    message("-------------------------------------")
+    message("           PROCESS STARTED           ")
+    message("-------------------------------------")
 
     for i in range(1, CRhrs + 1):
-        if folder == 'temp':
-            path = temp_path
-        elif folder == 'perm':
-            path = perm_path
+        with stage('TSG.hour', hour=i) as s:
+            if folder == 'temp':
+                path = temp_path
+            elif folder == 'perm':
+                path = perm_path
         
-        # Get full path for .txt file
-        dirpath = path / f"p{patient}"
-        file_name = f"p{patient}_{date}_{shift}_{batch}_{i}.txt"
-        file = dirpath / file_name
-
-        # Load raw data
-        data = pd.read_csv(file, sep='\t', skiprows=[0])
-
-        # Get the name of the column that contains the time (seconds) of each datapoint
-        time = data.columns[0]
-
-        # Change the column name to "sec"
-        if time == 'Time(s):':
-            data = data.rename(columns={'Time(s):': 'sec'})
-        else:
-            data = data.rename(columns={'Time (s):': 'sec'})
+            # Get full path for .txt file
+            dirpath = path / f"p{patient}"
+            file_name = f"p{patient}_{date}_{shift}_{batch}_{i}.txt"
+            file = dirpath / file_name
+
+            # Load raw data (channels parsed directly as SIGNAL_DTYPE, the time column stays float64)
+            dtypes = defaultdict(lambda: SIGNAL_DTYPE, {'Time(s):': 'float64', 'Time (s):': 'float64'})
+            data = pd.read_csv(file, sep='\t', skiprows=[0], dtype=dtypes)
+            s.count(data)
+
+            # Get the name of the column that contains the time (seconds) of each datapoint
+            time = data.columns[0]
+
+            # Change the column name to "sec"
+            if time == 'Time(s):':
+                data = data.rename(columns={'Time(s):': 'sec'})
+            else:
+                data = data.rename(columns={'Time (s):': 'sec'})
         
-        sec = data['sec'].to_numpy()
-
-        # Get full path for .c3d file
-        file_no_extension = os.path.splitext(file)[0]
-        c3d_file = pathlib.Path(f'{file_no_extension}.c3d')
-
-        if not os.path.exists(c3d_file): # Verify .c3d file existence
-            print('The C3D file was not found. Make sure to save it with the same name and path as the text file.')
-        else:
-            print(f'FILE {i} of {CRhrs}:')
-            print('Retrieving information...')
-
-            # Get the last modification date-time of the .c3d file
-            dt_vec = c3d_file.stat().st_mtime 
-            time_stopped = datetime.datetime.fromtimestamp(dt_vec).strftime('%d-%b-%Y %H:%M:%S.%f')
-            print(f'-Recording stopped at {time_stopped}')
+            sec = data['sec'].to_numpy()
+
+            # Get full path for .c3d file
+            file_no_extension = os.path.splitext(file)[0]
+            c3d_file = pathlib.Path(f'{file_no_extension}.c3d')
+
+            if not os.path.exists(c3d_file): # Verify .c3d file existence
+                message('The C3D file was not found. Make sure to save it with the same name and path as the text file.')
+            else:
+                message(f'FILE {i} of {CRhrs}:')
+                message('Retrieving information...')
+
+                # Get the last modification date-time of the .c3d file
+                dt_vec = c3d_file.stat().st_mtime 
+                time_stopped = datetime.datetime.fromtimestamp(dt_vec)
+                message(f'-Recording stopped at {time_stopped:%d-%b-%Y %H:%M:%S.%f}', time_stopped=time_stopped)
         
-            # Calculate the duration of the recording
-            duration_s = sec[-1]
-            print(f'-Recording duration is {duration_s} seconds')
-
-            # Calculate the time at which the recording started
-            time_started = (datetime.datetime.strptime(time_stopped, '%d-%b-%Y %H:%M:%S.%f') - datetime.timedelta(seconds=duration_s)).strftime('%d-%b-%Y %H:%M:%S.%f')
-            print(f'-Recording started at {time_started}')
-
-            # Sample frequency determination
-            tf = sec[1]
-            ti = sec[0]
-            T = tf - ti
-            fs = 1 / T
-            print(f'-Sample frequency is {fs} Hz')
-
-            print("Generating time-stamps for file...")
-
-            # Generate time-stamp for each datapoint and use it as index in the dataframe
-            data.index = pd.date_range(start=time_started, periods=len(sec), freq=pd.DateOffset(seconds=T)).strftime('%d-%b-%Y %H:%M:%S.%f')
-            data.index.name = 'Time'
+                # Calculate the duration of the recording
+                duration_s = sec[-1]
+                message(f'-Recording duration is {duration_s} seconds')
+
+                # Calculate the time at which the recording started
+                time_started = time_stopped - datetime.timedelta(seconds=duration_s)
+                message(f'-Recording started at {time_started:%d-%b-%Y %H:%M:%S.%f}')
+
+                # Sample frequency determination
+                tf = sec[1]
+                ti = sec[0]
+                T = tf - ti
+                fs = 1 / T
+                message(f'-Sample frequency is {fs} Hz', fs=fs)
+
+                message("Generating time-stamps for file...")
+
+                # Generate time-stamp for each datapoint (int64 ns, no string formatting) and use it as index in the dataframe
+                data.index = timestamps_ns(time_started, len(sec), T)
+                data.index.name = 'Time'
             
-            # Get full path for output .h5 file
-            hdf5file = temp_path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
+                # Get full path for output .h5 file
+                hdf5file = temp_path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
 
-            # Export data with time-stamps to .h5 file
-            data.to_hdf(hdf5file, key=f"Hour{i}")
-            print("Success!")
+                # Export data with time-stamps to .h5 file, along with the start time and sampling frequency
+                with pd.HDFStore(hdf5file) as store:
+                    store.put(f"Hour{i}", data)
+                    attrs = store.get_storer(f"Hour{i}").attrs
+                    attrs.start_ns = data.index[0].value
+                    attrs.fs = fs
+                message("Success!")
 
-    print("-------------------------------------")
-    print("            PROCESS ENDED            ")
-    print("-------------------------------------")
+    message("-------------------------------------")
+    message("            PROCESS ENDED            ")
+    message("-------------------------------------")
 
     end_timer = timer()
     elapsed = (end_timer - start_timer) / 60
-    print(f'Code executed in {elapsed:.2f} minutes')
-    print("-------------------------------------")
+    message(f'Code executed in {elapsed:.2f} minutes')
+    message("-------------------------------------")
 
     return None
 
@@ -122,7 +135,13 @@ if __name__ == '__main__':
     parser.add_argument('batch', type=int, help="Batch index of recordings from same shift")
     parser.add_argument('CRhrs', type=int, help="Number of continuous recording hours")
     parser.add_argument('folder', type=str, help="Location of files, temp or perm")
+    instrumentation.addArguments(parser)
 
     args = parser.parse_args()
+    collector = instrumentation.fromArguments(args)
 
-    TSG(args.patient, args.date, args.shift, args.batch, args.CRhrs, args.folder)
\ No newline at end of file
+    TSG(args.patient, args.date, args.shift, args.batch, args.CRhrs, args.folder)
+
+    if collector is not None:
+        collector.report(['stage', 'hour'])
+    instrumentation.disable()
\ No newline at end of file
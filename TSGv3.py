@@ -1,32 +1,134 @@
 import pandas as pd
+import numpy as np
 import datetime
+from instrumentation import stage, message   # type: ignore
+
+def timestamps_ns(time_started, nsamples, T):
+    """
+    Generates the time-stamp of each datapoint arithmetically from the start time and the period, as int64
+    nanoseconds since the epoch wrapped in a DatetimeIndex (no string formatting or parsing involved).
+
+    Args
+    -------------------------------
+    -time_started: datetime (or anything accepted by pd.Timestamp), time at which the recording started.
+    -nsamples: int, nb of datapoints.
+    -T: sampling period in seconds.
+
+    Returns
+    -------------------------------
+    -timestamps: DatetimeIndex containing the time-stamp of each datapoint.
+
+    """
+    start_ns = pd.Timestamp(time_started).value
+    return pd.DatetimeIndex((start_ns + offsets_ns(np.arange(nsamples), T)).view('datetime64[ns]'))
+
+def offsets_ns(k, T):
+    """
+    Offsets (int64 ns) of the samples k from the first one, given the sampling period T (s). Shared by timestamps_ns and
+    TimeAxis so that the stored and the derived time-stamps are always the same.
+    """
+    return np.round(np.asarray(k) * (T * 1e9)).astype(np.int64)
+
+def _resolution_ns(time):
+    # Resolution (ns) of a time string as parsed by pandas, e.g. 1 s for 'yyyy-mm-dd HH:MM:SS', 1 ms for 'yyyy-mm-dd HH:MM:SS.f'
+    clock = time.strip().replace('T', ' ').split(' ')[-1]
+    if ':' not in clock:
+        return 24 * 3600 * 10**9
+    if '.' in clock:
+        digits = len(clock.split('.')[-1])
+        return 10**(9 - 3 * min(-(-digits // 3), 3))
+    return [3600, 60, 1][clock.count(':')] * 10**9
+
+class TimeAxis:
+    """
+    Lightweight time axis of a recording, defined only by its start time, sampling frequency and nb of samples.
+    Wall-clock times are converted into sample offsets arithmetically, and the time-stamps (same values as
+    timestamps_ns) are only generated for the samples that are actually requested.
+
+    Attributes:
+    -------------------------------
+    -start: Timestamp, time-stamp of the first sample.
+    -fs: sampling frequency (Hz).
+    -samples: int, nb of samples.
+
+    """
+    def __init__(self, start, fs, samples):
+        self.start = pd.Timestamp(start)
+        self.fs = fs
+        self.samples = int(samples)
+
+    def __len__(self):
+        return self.samples
+
+    @property
+    def end(self):
+        return self.timestamps(slice(self.samples - 1, self.samples))[0]
+
+    def _ns(self, k):
+        return self.start.value + offsets_ns(k, 1 / self.fs)
+
+    def offset(self, time, side='left'):
+        """
+        Sample offset of a wall-clock time: first sample at or after it (side='left') or last sample at or before it (side='right').
+        As with label slicing on a DatetimeIndex, a string end time covers its whole resolution (e.g. '22:00:12' covers up to 22:00:12.999999999).
+        """
+        t = pd.Timestamp(time).value
+        if side == 'right' and isinstance(time, str):
+            t += _resolution_ns(time) - 1
+        k = int(np.floor((t - self.start.value) * 1e-9 * self.fs))
+
+        # Correct the rounding of the estimate against the exact time-stamps
+        while self._ns(k) > t:
+            k -= 1
+        while self._ns(k + 1) <= t:
+            k += 1
+        if side == 'left' and self._ns(k) < t:
+            k += 1
+        return k
+
+    def interval(self, startTime, endTime):
+        """
+        Slice of the samples within [startTime, endTime] (both included, like label slicing on a DatetimeIndex).
+        """
+        first = 0 if startTime is None else max(self.offset(startTime, 'left'), 0)
+        last = self.samples if endTime is None else min(self.offset(endTime, 'right') + 1, self.samples)
+        return slice(first, max(first, last))
+
+    def timestamps(self, rows=None):
+        """
+        DatetimeIndex of the samples in rows (slice, None for all samples), generated only for those samples.
+        """
+        rows = slice(None) if rows is None else rows
+        k = np.arange(*rows.indices(self.samples))
+        return pd.DatetimeIndex(self._ns(k).view('datetime64[ns]'))
 
 def generate_timestamps(c3d_filepath, time):
     # TODO: write docstring
-    print("Retrieving recording information...")
+    with stage('generate_timestamps') as s:
+        message("Retrieving recording information...")
 
-    # Get period
-    T = time[1] - time[0]
+        # Get period
+        T = time[1] - time[0]
 
-    # Get duration
-    dur = (len(time) - 1) * T
+        # Get duration
+        dur = (len(time) - 1) * T
 
-    # Get the last modification date-time of the c3d file
-    dt_mod = c3d_filepath.stat().st_mtime 
-    time_stopped = datetime.datetime.fromtimestamp(dt_mod).strftime('%d-%b-%Y %H:%M:%S.%f')
+        # Get the last modification date-time of the c3d file
+        dt_mod = c3d_filepath.stat().st_mtime 
+        time_stopped = datetime.datetime.fromtimestamp(dt_mod)
 
-    # Calculate the time at which the recording started
-    time_started = (datetime.datetime.strptime(time_stopped, '%d-%b-%Y %H:%M:%S.%f') - datetime.timedelta(seconds=dur)).strftime('%d-%b-%Y %H:%M:%S.%f')
-    
-    print(f'-Recording started at {time_started}')
-    print(f'-Recording stopped at {time_stopped}')
-    print(f'-Recording duration is {dur} seconds')
-    print(f'-Sample frequency is {1/T} Hz')
+        # Calculate the time at which the recording started
+        time_started = time_stopped - datetime.timedelta(seconds=dur)
+        
+        message(f'-Recording started at {time_started:%d-%b-%Y %H:%M:%S.%f}', time_started=time_started)
+        message(f'-Recording stopped at {time_stopped:%d-%b-%Y %H:%M:%S.%f}', time_stopped=time_stopped)
+        message(f'-Recording duration is {dur} seconds', duration=dur)
+        message(f'-Sample frequency is {1/T} Hz', fs=1/T)
 
-    # Generate time-stamp for each datapoint
-    print("Generating time-stamps...")
-    timestamps = pd.date_range(start=time_started, periods=len(time), freq=pd.DateOffset(seconds=T)).strftime('%d-%b-%Y %H:%M:%S.%f')
-    print("Success!")
+        # Generate time-stamp for each datapoint
+        message("Generating time-stamps...")
+        timestamps = timestamps_ns(time_started, len(time), T)
+        s.count(timestamps)
+        message("Success!")
 
     return timestamps
-
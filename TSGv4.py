@@ -0,0 +1,222 @@
+import os
+import pandas as pd
+import numpy as np
+import datetime
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from timeit import default_timer as timer
+from config import temp_path, perm_path # type: ignore
+from TSGv3 import timestamps_ns         # type: ignore
+from load_data import readAnalogBulk    # type: ignore
+import instrumentation                  # type: ignore
+from instrumentation import stage, message, emit  # type: ignore
+import argparse
+
+def convert_hour(c3d_file):
+    """
+    Reads one hour of EMG-ACM data directly from its C3D file and generates its time-stamps.
+
+    Args
+    -------------------------------
+    -c3d_file: path of the .c3d file.
+
+    Returns
+    -------------------------------
+    -data: dataframe containing the 'sec' column and the raw data, with the time-stamps (int64 ns) as indexes.
+    -fs: sampling frequency (Hz).
+    -elapsed: time spent converting the hour (s).
+
+    """
+    start_timer = timer()
+
+    data, fs = readAnalogBulk(c3d_file)
+    T = 1 / fs
+
+    # Time axis (units = seconds) as in EMG and Motion Tools
+    sec = np.arange(len(data)) * T
+    data.insert(0, 'sec', sec)
+
+    # The recording stopped at the last modification date-time of the .c3d file
+    time_stopped = datetime.datetime.fromtimestamp(c3d_file.stat().st_mtime)
+    time_started = time_stopped - datetime.timedelta(seconds=sec[-1])
+
+    data.index = timestamps_ns(time_started, len(data), T)
+    data.index.name = 'Time'
+
+    return data, fs, timer() - start_timer
+
+def convert_hours(pool, c3d_files, limit):
+    """
+    Converts hours (see convert_hour) on a pool of processes, keeping at most `limit` hours in flight: the next hour is
+    only submitted once a converted one has been handed over and processed by the caller. Converted hours that are
+    not written yet therefore never pile up in memory, whatever the nb of hours.
+
+    Args
+    -------------------------------
+    -pool: ProcessPoolExecutor.
+    -c3d_files: dict mapping a key (e.g. the hour index) to the path of each .c3d file.
+    -limit: int, maximum nb of hours being converted or waiting to be processed, e.g. the nb of workers.
+
+    Yields
+    -------------------------------
+    -key: key of the converted hour.
+    -result: (data, fs, elapsed) returned by convert_hour. The caller should drop it before asking for the next hour.
+
+    """
+    pending = iter(c3d_files.items())
+    jobs = {}
+
+    def submit(n):
+        for key, c3d_file in itertools.islice(pending, n):
+            jobs[pool.submit(convert_hour, c3d_file)] = key
+
+    submit(limit)
+    while jobs:
+        finished, _ = wait(jobs, return_when=FIRST_COMPLETED)
+        while finished:
+            # Drop every reference to the future (which holds the converted hour) once it is handed over
+            job = finished.pop()
+            key = jobs.pop(job)
+            result = job.result()
+            del job
+            yield key, result
+            del result
+            submit(1)
+
+def write_hour(hdf5file, i, data, fs, layout='fixed'):
+    """
+    Writes one converted hour to the batch's HDF5 file, along with its start time and sampling frequency.
+
+    Layouts:
+    -'fixed': one uncompressed key 'Hour{i}' with all the columns (same as TSGv2).
+    -'table': two blosc:lz4-compressed tables, 'Hour{i}/emg' ('sec' and the 8 EMG channels) and 'Hour{i}/acm'
+              (the ACM channels), with an indexed time column. A modality and/or a time interval can then be read
+              without reading the rest of the hour (see load_data.readHour).
+
+    Args
+    -------------------------------
+    -hdf5file: path of the output .h5 file.
+    -i: int, hour index within the batch.
+    -data: dataframe returned by convert_hour.
+    -fs: sampling frequency (Hz).
+    -layout: either 'fixed' or 'table', default: 'fixed'
+
+    Returns
+    -------------------------------
+    None
+
+    """
+    if layout == 'table':
+        channels = data.columns.drop('sec')
+        parts = {f"Hour{i}/emg": data[['sec'] + list(channels[0:8])], f"Hour{i}/acm": data[channels[8:]]}
+    else:
+        parts = {f"Hour{i}": data}
+
+    with pd.HDFStore(hdf5file) as store:
+        for key, part in parts.items():
+            if layout == 'table':
+                store.put(key, part, format='table', index=True, complib='blosc:lz4', complevel=5)
+            else:
+                store.put(key, part)
+            attrs = store.get_storer(key).attrs
+            attrs.start_ns = data.index[0].value
+            attrs.fs = fs
+
+    return None
+
+@stage('TSG')
+def TSG(patient, date, shift, batch, CRhrs, folder, workers=None, layout='fixed'):
+    """
+    Generates the time-stamps for a full batch of EMG-ACM recordings acquired with the Cometa system and exports them
+    (along with the raw data) to an HDF5 file in the temporary folder, reading the C3D files directly (no text export
+    is needed). The hours are converted in parallel on a pool of processes, while a single writer (this process)
+    appends them to the .h5 file, so the file is never written concurrently.
+
+    Requirements:
+    -Original C3D files (or the unmodified versions)
+
+    Args
+    -------------------------------
+    -patient: patient's assigned number/code without the 'p'.
+    -date: date that appears in the file names, format yyyymmdd.
+    -shift: either 'D' (day/morning shift), 'A' (afternoon shift), or 'N' (night shift) as appears in file names.
+    -batch: recording batch number as appears in file names.
+    -CRhrs: total number of continuous recording hours (total nb of files in the batch).
+    -folder: either 'temp' (temporary folder) or 'perm' (permanent folder), depending on the location of the .c3d files.
+    -workers: int, nb of processes converting hours in parallel, default: nb of CPUs
+    -layout: either 'fixed' or 'table' (compressed, queryable by modality and time, see write_hour), default: 'fixed'
+
+    Returns
+    -------------------------------
+    None
+
+    """
+    start_timer = timer()
+
+    message("-------------------------------------")
+    message("           PROCESS STARTED           ")
+    message("-------------------------------------")
+
+    if folder == 'temp':
+        path = temp_path
+    elif folder == 'perm':
+        path = perm_path
+
+    dirpath = path / f"p{patient}"
+    hdf5file = temp_path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
+
+    c3d_files = {}
+    for i in range(1, CRhrs + 1):
+        c3d_file = dirpath / f"p{patient}_{date}_{shift}_{batch}_{i}.c3d"
+        if not os.path.exists(c3d_file): # Verify .c3d file existence
+            message(f'The C3D file of hour {i} was not found ({c3d_file}).')
+        else:
+            c3d_files[i] = c3d_file
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Single writer: hours are written as soon as they are converted, with at most `workers` hours in memory
+        for done, (i, (data, fs, elapsed)) in enumerate(convert_hours(pool, c3d_files, workers), start=1):
+            # The conversion ran in a worker process: only its elapsed time is known here
+            emit('convert_hour', elapsed, hour=i, samples=len(data), nbytes=int(data.memory_usage(index=False).sum()))
+
+            write_timer = timer()
+            with stage('write_hour', hour=i) as s:
+                write_hour(hdf5file, i, data, fs, layout)
+                s.count(data)
+
+            message(f'FILE {i} of {CRhrs} ({done}/{len(c3d_files)} done): {len(data)} samples at {fs} Hz, '
+                    f'converted in {elapsed:.2f} s, written in {timer() - write_timer:.2f} s', hour=i)
+            del data
+
+    message("-------------------------------------")
+    message("            PROCESS ENDED            ")
+    message("-------------------------------------")
+
+    end_timer = timer()
+    elapsed = (end_timer - start_timer) / 60
+    message(f'Code executed in {elapsed:.2f} minutes')
+    message("-------------------------------------")
+
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Generate time-stamps directly from C3D files")
+    parser.add_argument('patient', type=int, help="The patient number/code")
+    parser.add_argument('date', type=int, help="Date of recording in format yyyymmdd")
+    parser.add_argument('shift', type=str, help="D, A, or N shift")
+    parser.add_argument('batch', type=int, help="Batch index of recordings from same shift")
+    parser.add_argument('CRhrs', type=int, help="Number of continuous recording hours")
+    parser.add_argument('folder', type=str, help="Location of files, temp or perm")
+    parser.add_argument('--workers', type=int, default=None, help="Number of hours converted in parallel")
+    parser.add_argument('--layout', type=str, default='fixed', help="HDF5 layout, fixed or table")
+    instrumentation.addArguments(parser)
+
+    args = parser.parse_args()
+    collector = instrumentation.fromArguments(args)
+
+    TSG(args.patient, args.date, args.shift, args.batch, args.CRhrs, args.folder, args.workers, args.layout)
+
+    if collector is not None:
+        collector.report(['stage', 'hour'])
+    instrumentation.disable()
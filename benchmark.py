@@ -0,0 +1,398 @@
+import os
+import json
+import datetime
+import subprocess
+import tracemalloc
+import tempfile
+import pathlib
+import numpy as np
+import pandas as pd
+from timeit import default_timer as timer
+from processing_tools import FilterPipeline, preprocess
+from feature_extraction import extractFeatures, FEATURES
+from load_data import readAnalogFrames, readAnalogBulk, loadHDF5, loadC3D, hourKeys, parseTimestamps
+from synthetic import writeSyntheticHDF5, writeSyntheticBatch
+import argparse
+
+def benchmarkParallelFilter(hours=1, fs=1000, channels=8, workers=(1, 2, 4, 8), hp_cutoff=20, notch_cutoffs=(58, 62)):
+    """
+    Measures how segment-parallel filtering (FilterPipeline.applyParallel) scales with the nb of workers,
+    compared to a single sequential pass, on a synthetic signal.
+
+    Args:
+    -----------------------------------------------------------------
+    -hours: duration of the synthetic signal (hours), default: 1
+    -fs: sampling frequency of the synthetic signal, default: 1000 Hz
+    -channels: int, nb of channels, default: 8
+    -workers: sequence of ints, nb of workers to test, default: (1, 2, 4, 8)
+    -hp_cutoff: int, cutoff frequency (Hz) for the highpass filter, default: 20
+    -notch_cutoffs: length-2 sequence, cutoff frequencies (Hz) for bandstop filter, default: (58, 62)
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping 'sequential' and each nb of workers to the elapsed time (s).
+
+    """
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((int(hours * 3600 * fs), channels))
+    pipeline = FilterPipeline(fs).highpass(hp_cutoff).notch(notch_cutoffs)
+
+    results = {}
+    start_timer = timer()
+    reference = pipeline.apply(data)
+    results['sequential'] = timer() - start_timer
+    print(f"Sequential: {results['sequential']:.2f} s")
+
+    for n in workers:
+        start_timer = timer()
+        filtered = pipeline.applyParallel(data, workers=n)
+        results[n] = timer() - start_timer
+        error = np.max(np.abs(filtered - reference))
+        print(f"{n} workers: {results[n]:.2f} s (speedup x{results['sequential'] / results[n]:.2f}, max error {error:.2e})")
+
+    return results
+
+def benchmarkC3DReader(file):
+    """
+    Compares the frame-by-frame (readAnalogFrames) and bulk (readAnalogBulk) C3D analog readers on one file
+    (e.g. an hour-long recording) and checks that they return the same data.
+
+    Args:
+    -----------------------------------------------------------------
+    -file: path of the .c3d file.
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping 'frames' and 'bulk' to the elapsed time (s).
+
+    """
+    results = {}
+    outputs = {}
+    for name, reader in [('frames', readAnalogFrames), ('bulk', readAnalogBulk)]:
+        start_timer = timer()
+        outputs[name], _ = reader(file)
+        results[name] = timer() - start_timer
+        print(f"{name}: {results[name]:.2f} s")
+
+    error = np.max(np.abs(outputs['frames'].to_numpy() - outputs['bulk'].to_numpy()))
+    print(f"Speedup x{results['frames'] / results['bulk']:.2f}, {len(outputs['bulk'])} samples, max error {error:.2e}")
+
+    return results
+
+def benchmarkLayouts(hours=1, fs=2000, interval=60, directory=None):
+    """
+    Compares the 'fixed' and 'table' HDF5 layouts (see TSGv4.write_hour) on a synthetic batch: file size, time to read
+    the full EMG data and time to read the EMG data of a short interval (loadHDF5 with modality='emg').
+
+    Args:
+    -----------------------------------------------------------------
+    -hours: int, nb of hours in the synthetic batch, default: 1
+    -fs: sampling frequency of the synthetic batch, default: 2000 Hz
+    -interval: duration (s) of the interval read in the middle of the batch, default: 60
+    -directory: folder where the synthetic files are written, default: a temporary folder
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping each layout to a dict with its 'size' (MB), 'read_full' (s) and 'read_interval' (s).
+
+    """
+    directory = pathlib.Path(directory or tempfile.mkdtemp())
+
+    results = {}
+    for layout in ['fixed', 'table']:
+        file = directory / f"benchmark_{layout}.h5"
+        start = writeSyntheticHDF5(file, hours, fs, layout)
+
+        middle = start + pd.Timedelta(hours=hours / 2)
+        start_timer = timer()
+        full, _ = loadHDF5(file, 0, 'emg')
+        read_full = timer() - start_timer
+        start_timer = timer()
+        part, _ = loadHDF5(file, 0, 'emg', middle, middle + pd.Timedelta(seconds=interval))
+        read_interval = timer() - start_timer
+
+        results[layout] = {'size': file.stat().st_size / 1e6, 'read_full': read_full, 'read_interval': read_interval}
+        print(f"{layout}: {results[layout]['size']:.1f} MB, full EMG read in {read_full:.2f} s, "
+              f"{interval} s of EMG ({len(part)} samples) read in {read_interval:.3f} s")
+
+    return results
+
+def loadHDF5Concat(file, modality):
+    """
+    Previous multi-hour load path of readHDF5(hrIdx=0), kept as a reference: every hour is read with pd.read_hdf
+    (reopening the file), concatenated, then 'sec' is dropped, the modality selected and the result downsampled.
+    """
+    dataframes = []
+    with pd.HDFStore(file, mode='r') as store:
+        hours = list(hourKeys(store))
+    for i in hours:
+        dataframes.append(pd.read_hdf(file, f"Hour{i}"))
+    data = pd.concat(dataframes)
+
+    time_s = data['sec'].values[::2]
+    data = data.drop(columns=['sec'])
+    if modality == 'emg':
+        data = data.iloc[:, 0:8]
+    elif modality == 'acm':
+        data = data.drop(data.columns[0:8], axis=1)
+    data_ds = data.iloc[::2, :].copy()
+    data_ds.index = parseTimestamps(data_ds.index)
+
+    return data_ds, time_s
+
+def benchmarkLoadHDF5(hours=12, fs=2000, modality='emg', directory=None):
+    """
+    Compares the peak memory (tracemalloc) and time of the preallocated multi-hour load path (loadHDF5) with the
+    previous concatenation path (loadHDF5Concat) on a synthetic batch ('fixed' layout), and checks that they match.
+
+    Args:
+    -----------------------------------------------------------------
+    -hours: int, nb of hours in the synthetic batch, default: 12
+    -fs: sampling frequency of the synthetic batch, default: 2000 Hz
+    -modality: either 'emg', 'acm' or 'both', default: 'emg'
+    -directory: folder where the synthetic file is written, default: a temporary folder
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping 'concat' and 'preallocated' to a dict with the elapsed 'time' (s) and 'peak' memory (MB).
+
+    """
+    file = pathlib.Path(directory or tempfile.mkdtemp()) / "benchmark_load.h5"
+    writeSyntheticHDF5(file, hours, fs, 'fixed')
+
+    results = {}
+    outputs = {}
+    for name, load in [('concat', loadHDF5Concat), ('preallocated', lambda f, m: loadHDF5(f, 0, m))]:
+        tracemalloc.start()
+        start_timer = timer()
+        outputs[name] = load(file, modality)
+        elapsed = timer() - start_timer
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[name] = {'time': elapsed, 'peak': peak / 1e6}
+        print(f"{name}: {elapsed:.2f} s, peak memory {peak / 1e6:.1f} MB (output {outputs[name][0].to_numpy().nbytes / 1e6:.1f} MB)")
+
+    pd.testing.assert_frame_equal(outputs['concat'][0], outputs['preallocated'][0])
+    return results
+
+def benchmarkDtype(hours=1, fs=2000, modality='emg', sliding_window=2, overlap=1, directory=None):
+    """
+    Runs loadHDF5 -> preprocess -> extractFeatures on a synthetic batch in float64 and in float32 (see load_data.SIGNAL_DTYPE),
+    reports the time, peak memory (tracemalloc) and output size of each stage, and the error of the float32 results
+    (filtered signal and each feature) relative to float64.
+
+    Args:
+    -----------------------------------------------------------------
+    -hours: int, nb of hours in the synthetic batch, default: 1
+    -fs: sampling frequency of the synthetic batch (before the ::2 downsampling), default: 2000 Hz
+    -modality: either 'emg', 'acm' or 'both', default: 'emg'
+    -sliding_window: duration of each window (s), default: 2
+    -overlap: duration of the overlap between two consecutive windows (s), default: 1
+    -directory: folder where the synthetic file is written, default: a temporary folder
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping each dtype name to a dict mapping each stage to its 'time' (s), 'peak' and 'output' memory (MB),
+              plus 'error' mapping 'filtered' and each feature to the max absolute error of float32 relative to the max absolute float64 value.
+
+    """
+    file = pathlib.Path(directory or tempfile.mkdtemp()) / "benchmark_dtype.h5"
+    writeSyntheticHDF5(file, hours, fs, 'fixed')
+
+    stages = [('load', lambda data, dtype: loadHDF5(file, 0, modality, dtype=dtype)[0]),
+              ('preprocess', lambda data, dtype: preprocess(data, 20, (58, 62), fs=fs / 2)),
+              ('features', lambda data, dtype: extractFeatures(data, sliding_window, overlap, fs=fs / 2))]
+
+    results = {}
+    outputs = {}
+    for dtype in [np.float64, np.float32]:
+        name = np.dtype(dtype).name
+        results[name] = {}
+        outputs[name] = {}
+        data = None
+        for stage, run in stages:
+            tracemalloc.start()
+            start_timer = timer()
+            data = run(data, dtype)
+            elapsed = timer() - start_timer
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            frames = data.values() if isinstance(data, dict) else [data]
+            size = sum(frame.to_numpy().nbytes for frame in frames)
+            results[name][stage] = {'time': elapsed, 'peak': peak / 1e6, 'output': size / 1e6}
+            outputs[name][stage] = data
+            print(f"{name} {stage}: {elapsed:.2f} s, peak memory {peak / 1e6:.1f} MB, output {size / 1e6:.1f} MB")
+
+    reference, single = outputs['float64'], outputs['float32']
+    error = {}
+    filtered = reference['preprocess'].to_numpy()
+    error['filtered'] = np.max(np.abs(single['preprocess'].to_numpy() - filtered)) / np.max(np.abs(filtered))
+    for feature in FEATURES:
+        exact = np.stack([frame[feature].to_numpy() for frame in reference['features'].values()])
+        approx = np.stack([frame[feature].to_numpy() for frame in single['features'].values()])
+        error[feature] = np.max(np.abs(approx - exact)) / np.max(np.abs(exact))
+    results['error'] = error
+    print("float32 error (relative to float64): " + ", ".join(f"{key} {value:.1e}" for key, value in error.items()))
+
+    return results
+
+def _commit():
+    # Commit of the working tree (None outside a git repository)
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmarkSuite(sizes=(1, 4, 12), fs=2000, seconds=3600, directory=None, output=None, sliding_window=2, overlap=1):
+    """
+    Times and memory-profiles the main stages of the pipeline on synthetic batches (see synthetic.writeSyntheticBatch)
+    of each size: readC3D (every hour of the batch), readHDF5 (full batch, EMG), preprocess, extractFeatures and plotEMG.
+    For every stage, the wall time, CPU time and peak memory (tracemalloc) are recorded. The results are written
+    to a JSON file along with the commit, so that runs on different commits can be compared (see compareBenchmarks).
+
+    Args:
+    -----------------------------------------------------------------
+    -sizes: sequence of ints, nb of hours of each synthetic batch, default: (1, 4, 12)
+    -fs: sampling frequency of the synthetic batches, default: 2000 Hz
+    -seconds: duration of each "hour" (s), shorter for quick runs, default: 3600
+    -directory: folder where the synthetic batches are written, default: a temporary folder
+    -output: path of the JSON file, default: 'benchmark.json' in the folder of the synthetic batches
+    -sliding_window, overlap: duration (s) of each window and of the overlap between two consecutive windows, default: 2, 1
+
+    Returns:
+    -----------------------------------------------------------------
+    -report: dict with the 'commit', 'date', parameters and 'results' (dict mapping each size, e.g. '4h', to a dict
+             mapping each stage to its 'time' (s), 'cpu' (s) and 'peak' memory (MB)).
+
+    """
+    import matplotlib.pyplot as plt
+    from plot_tools import plotEMG
+    plt.switch_backend('Agg')
+
+    directory = pathlib.Path(directory or tempfile.mkdtemp())
+    report = {'commit': _commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'fs': fs, 'seconds': seconds, 'sliding_window': sliding_window, 'overlap': overlap, 'results': {}}
+
+    for hours in sizes:
+        print(f"{hours} h: generating the synthetic batch...")
+        files = writeSyntheticBatch(directory / f"{hours}h", hours=hours, fs=fs, seconds=seconds)
+
+        def readC3D(data):
+            for c3d_file in files['c3d']:
+                loadC3D(c3d_file, 'emg')
+
+        def plot(data):
+            plotEMG(data, title=str(directory / f"{hours}h" / 'EMG'))
+            plt.close('all')
+
+        stages = [('readC3D', readC3D),
+                  ('readHDF5', lambda data: loadHDF5(files['h5'], 0, 'emg')[0]),
+                  ('preprocess', lambda data: preprocess(data, 20, (58, 62), fs=fs / 2)),
+                  ('extractFeatures', lambda data: extractFeatures(data, sliding_window, overlap, fs=fs / 2)),
+                  ('plotEMG', plot)]
+
+        results = {}
+        data = filtered = None
+        for stage, run in stages:
+            # Features and plots are computed from the filtered data
+            argument = filtered if stage in ('extractFeatures', 'plotEMG') else data
+            tracemalloc.start()
+            start_timer, start_cpu = timer(), os.times()
+            result = run(argument)
+            end_timer, end_cpu = timer(), os.times()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            if stage == 'readHDF5':
+                data = result
+            elif stage == 'preprocess':
+                filtered = result
+            results[stage] = {'time': end_timer - start_timer,
+                              'cpu': (end_cpu.user + end_cpu.system) - (start_cpu.user + start_cpu.system),
+                              'peak': peak / 1e6}
+            print(f"{hours} h {stage}: {results[stage]['time']:.2f} s (CPU {results[stage]['cpu']:.2f} s), "
+                  f"peak memory {results[stage]['peak']:.1f} MB")
+
+        report['results'][f"{hours}h"] = results
+        del data, filtered
+
+    output = output or directory / 'benchmark.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    return report
+
+def compareBenchmarks(before, after, tolerance=0.1):
+    """
+    Compares two JSON reports of benchmarkSuite (e.g. from two commits) and prints the ratio after / before of the time
+    and peak memory of every stage and size, flagging the regressions larger than tolerance.
+
+    Args:
+    -----------------------------------------------------------------
+    -before, after: paths of the JSON reports.
+    -tolerance: relative increase above which a stage is flagged as a regression, default: 0.1 (10%)
+
+    Returns:
+    -----------------------------------------------------------------
+    -regressions: list of (size, stage, metric, ratio) tuples.
+
+    """
+    reports = []
+    for file in (before, after):
+        with open(file) as f:
+            reports.append(json.load(f))
+    print(f"{reports[0]['commit']} -> {reports[1]['commit']}")
+
+    regressions = []
+    for size, stages in reports[1]['results'].items():
+        for stage, metrics in stages.items():
+            reference = reports[0]['results'].get(size, {}).get(stage)
+            if reference is None:
+                continue
+            ratios = {metric: metrics[metric] / reference[metric] if reference[metric] else float('nan') for metric in ('time', 'peak')}
+            flags = [metric for metric, ratio in ratios.items() if ratio > 1 + tolerance]
+            regressions += [(size, stage, metric, ratios[metric]) for metric in flags]
+            print(f"{size} {stage}: time x{ratios['time']:.2f}, peak memory x{ratios['peak']:.2f}"
+                  + (f"  <- REGRESSION ({', '.join(flags)})" if flags else ""))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the processing pipeline")
+    parser.add_argument('--hours', type=float, default=1, help="Duration of the synthetic recording (hours)")
+    parser.add_argument('--fs', type=float, default=None, help="Sampling frequency (Hz), default: that of each benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()], help="Nb of workers to test")
+    parser.add_argument('--c3d', type=str, default=None, help="C3D file used to compare the analog readers")
+    parser.add_argument('--layouts', action='store_true', help="Compare the fixed and table HDF5 layouts")
+    parser.add_argument('--load', action='store_true', help="Compare the multi-hour HDF5 load paths on a 12-hour batch")
+    parser.add_argument('--dtype', action='store_true', help="Compare float64 and float32 (memory per stage and accuracy)")
+    parser.add_argument('--suite', action='store_true', help="Run the pipeline benchmark suite on synthetic batches")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 12], help="Nb of hours of the synthetic batches of the suite")
+    parser.add_argument('--seconds', type=float, default=3600, help="Duration of each synthetic hour (s) of the suite")
+    parser.add_argument('--output', type=str, default=None, help="JSON file where the results of the suite are written (default: in the temporary folder)")
+    parser.add_argument('--compare', type=str, nargs=2, default=None, help="Compare two JSON reports of the suite (before, after)")
+
+    args = parser.parse_args()
+    # Only override the sampling frequency of the benchmarks if it was given (1000 Hz for the filters, 2000 Hz otherwise)
+    fs = {} if args.fs is None else {'fs': args.fs}
+
+    if args.compare is not None:
+        compareBenchmarks(*args.compare)
+        raise SystemExit
+    if args.suite:
+        benchmarkSuite(args.sizes, seconds=args.seconds, output=args.output, **fs)
+        raise SystemExit
+
+    benchmarkParallelFilter(args.hours, workers=args.workers, **fs)
+    if args.c3d is not None:
+        benchmarkC3DReader(args.c3d)
+    if args.layouts:
+        benchmarkLayouts(max(1, int(args.hours)))
+    if args.load:
+        benchmarkLoadHDF5(12, **fs)
+    if args.dtype:
+        benchmarkDtype(max(1, int(args.hours)), **fs)
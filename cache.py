@@ -0,0 +1,236 @@
+import os
+import json
+import pickle
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from config import temp_path, perm_path               # type: ignore
+from load_data import readHDF5, SIGNAL_DTYPE          # type: ignore
+from processing_tools import preprocess               # type: ignore
+from feature_extraction import extractFeatures        # type: ignore
+
+# Default location of the cache: a local folder, not the network share holding the patient data
+cache_dir = Path.home() / '.cache' / 'seizuredetection'
+
+# Default maximum size of the cache (bytes)
+CACHE_SIZE = 20 * 2**30
+
+def fileIdentity(file, content=False):
+    """
+    Identity of a source file used in the cache keys: its resolved path, size and modification time, or a hash of its
+    content if content=True (slower, but survives copies and touches).
+    """
+    file = Path(file)
+    if content:
+        digest = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                digest.update(block)
+        return {'sha256': digest.hexdigest()}
+    stat = file.stat()
+    return {'path': str(file.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _keyPart(value):
+    """
+    JSON-serializable form of a key part that json cannot encode. Arrays and dataframes are identified by a hash of
+    their content (with their shape, dtype, index and columns), never by their repr, which is truncated.
+    """
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return {'ndarray': digest, 'shape': value.shape, 'dtype': value.dtype.str}
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest = hashlib.sha256(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes()).hexdigest()
+        columns = list(map(str, value.columns)) if isinstance(value, pd.DataFrame) else value.name
+        dtypes = list(map(str, value.dtypes)) if isinstance(value, pd.DataFrame) else str(value.dtype)
+        return {type(value).__name__: digest, 'shape': value.shape, 'columns': columns, 'dtypes': dtypes}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime.date, datetime.timedelta, pd.Timestamp, pd.Timedelta, Path)):
+        return str(value)
+    raise TypeError(f"Cannot use a {type(value).__name__} in a cache key")
+
+class DiskCache:
+    """
+    Persistent, content-addressed cache of the results of the processing stages (filtered signals, feature matrices).
+    Each result is stored in its own pickle file named after the hash of its key, i.e. of everything it depends on
+    (source file identity, hour, parameters and, for a downstream stage, the key of the upstream stage). A parameter
+    change therefore only misses the stages at and after it. The least recently used results are evicted when the
+    total size exceeds max_size (a hit refreshes the modification time of the file, which gives the LRU order).
+
+    Attributes:
+    -------------------------------
+    -directory: folder containing the cached results.
+    -max_size: maximum total size of the cached results (bytes).
+    -stats: dict mapping each stage to its nb of 'hits' and 'misses' since the cache was opened.
+
+    """
+    def __init__(self, directory=None, max_size=CACHE_SIZE):
+        self.directory = Path(directory or cache_dir)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.stats = {}
+
+    def key(self, stage, *parts):
+        """
+        Key (hex digest) of the result of a stage computed from the given parts (JSON-serializable, or arrays and
+        dataframes, hashed by content, see _keyPart). Raises TypeError for other types.
+        """
+        text = json.dumps([stage, *parts], sort_keys=True, default=_keyPart)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.pkl"
+
+    def _count(self, stage, outcome):
+        self.stats.setdefault(stage, {'hits': 0, 'misses': 0})[outcome] += 1
+
+    def get(self, key, stage=None):
+        """
+        Cached result of a key, or None if it is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self._count(stage, 'misses')
+            return None
+        os.utime(path)
+        self._count(stage, 'hits')
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a result (atomically, a crash never leaves a truncated file) and evicts the least recently used results if needed.
+        """
+        path = self._path(key)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.evict()
+
+    def entries(self):
+        """
+        List of (modification time, size, path) of the cached results, least recently used first.
+        """
+        entries = []
+        for path in self.directory.glob('*.pkl'):
+            stat = path.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Removes the least recently used results until the total size is at most max_size.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            path.unlink(missing_ok=True)
+
+    def report(self):
+        """
+        Prints the hit/miss statistics of each stage and the size of the cache.
+        """
+        for stage, counts in self.stats.items():
+            total = counts['hits'] + counts['misses']
+            print(f"-{stage}: {counts['hits']} hits, {counts['misses']} misses ({100 * counts['hits'] / total:.0f}% hit rate)")
+        print(f"-cache size: {self.size / 2**20:.1f} MB of {self.max_size / 2**20:.0f} MB ({len(self.entries())} results)")
+
+def preprocessKey(cache, patient, date, shift, batch, hrIdx, folder, modality, hp_cutoff, notch_cutoffs, fs=1000,
+                  startTime=None, endTime=None, step=2, dtype=SIGNAL_DTYPE, factor=1, decimation='fir', content=False):
+    """
+    Key of the filtered data returned by cachedPreprocess (same arguments), computed without loading anything.
+    """
+    if folder == 'temp':
+        path = temp_path
+    elif folder == 'perm':
+        path = perm_path
+    file = path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
+
+    source = {'file': fileIdentity(file, content), 'hrIdx': hrIdx, 'modality': modality, 'startTime': startTime,
+              'endTime': endTime, 'step': step, 'dtype': np.dtype(dtype).name}
+    filtering = {'hp_cutoff': hp_cutoff, 'notch_cutoffs': list(notch_cutoffs), 'fs': fs, 'factor': factor, 'decimation': decimation}
+    return cache.key('preprocess', source, filtering)
+
+def cachedPreprocess(cache, patient, date, shift, batch, hrIdx, folder, modality, hp_cutoff, notch_cutoffs, fs=1000,
+                     startTime=None, endTime=None, step=2, dtype=SIGNAL_DTYPE, factor=1, decimation='fir', content=False, workers=None):
+    """
+    readHDF5 -> preprocess through the cache: the filtered data is only computed (and stored) if it is not cached yet.
+
+    Args:
+    -----------------------------------------------------------------
+    -cache: DiskCache.
+    -patient, date, shift, batch, hrIdx, folder, modality, startTime, endTime, step, dtype: data to load (see readHDF5).
+    -hp_cutoff, notch_cutoffs, fs, factor, decimation, workers: pre-processing parameters (see preprocess). workers does not change the result and is not part of the key.
+    -content: bool, whether to identify the source file by the hash of its content instead of its path, size and modification time, default: False
+
+    Returns:
+    -----------------------------------------------------------------
+    -data_filtered: dataframe containing the filtered data.
+    -key: key of the filtered data.
+
+    """
+    key = preprocessKey(cache, patient, date, shift, batch, hrIdx, folder, modality, hp_cutoff, notch_cutoffs, fs,
+                        startTime, endTime, step, dtype, factor, decimation, content)
+
+    data_filtered = cache.get(key, 'preprocess')
+    if data_filtered is None:
+        data, _ = readHDF5(patient, date, shift, batch, hrIdx, folder, modality, startTime, endTime, step, dtype)
+        data_filtered = preprocess(data, hp_cutoff, notch_cutoffs, fs, dtype=dtype, workers=workers, factor=factor, decimation=decimation)
+        cache.put(key, data_filtered)
+
+    return data_filtered, key
+
+def cachedFeatures(cache, patient, date, shift, batch, hrIdx, folder, modality, hp_cutoff, notch_cutoffs, sliding_window, overlap,
+                   fs=1000, preprocess_kwargs=None, **kwargs):
+    """
+    readHDF5 -> preprocess -> extractFeatures through the cache. The features are keyed by the key of the filtered
+    data and the feature parameters: changing only the feature parameters reuses the cached filtered data, changing
+    a loading or filtering parameter recomputes both stages, and nothing is loaded when the features are cached.
+
+    Args:
+    -----------------------------------------------------------------
+    -cache: DiskCache.
+    -patient, date, shift, batch, hrIdx, folder, modality: data to load (see readHDF5).
+    -hp_cutoff, notch_cutoffs: pre-processing parameters (see preprocess).
+    -sliding_window, overlap: duration (s) of each window and of the overlap between two consecutive windows.
+    -fs: sampling frequency of the loaded data, default: 1000 Hz
+    -preprocess_kwargs: dict, other arguments of cachedPreprocess (e.g. startTime, endTime, factor), default: None
+    -kwargs: other arguments passed to extractFeatures (e.g. incremental, pairs).
+
+    Returns:
+    -----------------------------------------------------------------
+    -features: dict mapping each channel name to a dataframe (windows x features), see extractFeatures.
+
+    """
+    preprocess_kwargs = preprocess_kwargs or {}
+    recording = (patient, date, shift, batch, hrIdx, folder, modality, hp_cutoff, notch_cutoffs, fs)
+    upstream = preprocessKey(cache, *recording, **{k: v for k, v in preprocess_kwargs.items() if k != 'workers'})
+
+    fs_filtered = fs / preprocess_kwargs.get('factor', 1)
+    parameters = {'sliding_window': sliding_window, 'overlap': overlap, 'fs': fs_filtered,
+                  **{k: v for k, v in kwargs.items() if k != 'count_ffts'}}
+    key = cache.key('features', upstream, parameters)
+
+    features = cache.get(key, 'features')
+    if features is None:
+        data_filtered, _ = cachedPreprocess(cache, *recording, **preprocess_kwargs)
+        features = extractFeatures(data_filtered, sliding_window, overlap, fs_filtered, **kwargs)
+        cache.put(key, features)
+
+    return features
@@ -1,62 +1,548 @@
+import math
+import itertools
+import numpy as np
 import pandas as pd
-from load_data import readHDF5, readC3D
-from processing_tools import preprocess
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft
+from load_data import readHDF5, readC3D, iterHDF5
+from processing_tools import preprocess, FilterPipeline
+from instrumentation import message     # type: ignore
+
+# Features computed for every window and channel (in output column order)
+FEATURES = ['RMS', 'ZCR', 'MF', 'VAR', 'iEMG', 'RP']
+
+# Features that can be updated incrementally from running sums (see runningFeatures)
+RUNNING_FEATURES = ['RMS', 'ZCR', 'VAR', 'iEMG']
+
+# Frequency band (Hz) used as numerator in the relative power
+RP_BAND = (20, 150)
+
+# Frequency band (Hz) over which the coherence is averaged
+COH_BAND = (20, 150)
+
+# Default nb of segments per window used to estimate the coherence
+COH_SEGMENTS = 8
+
+# Default ACM activity (std of the vector magnitude within a window, in the units of the ACM channels) below which
+# a window is considered quiet and its EMG features are skipped in the cascade mode (see acmActivity)
+ACM_THRESHOLD = 0.02
+
+# Maximum subsampling step of the ACM channels when computing the activity (the motion content is far below fs / 20)
+ACM_STRIDE = 10
+
+def slidingWindows(data, window_size, step):
+    """
+    Builds a zero-copy strided view over all the sliding windows of a (multi-channel) signal.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: dataframe or array (samples x channels) containing the signal.
+    -window_size: int, nb of samples in each window.
+    -step: int, nb of samples between the starts of two consecutive windows.
+
+    Returns:
+    -----------------------------------------------------------------
+    -windows: read-only array view of shape (windows x samples x channels). No data is copied.
+
+    """
+    values = np.asarray(data)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+
+    if len(values) < window_size:
+        return np.empty((0, window_size, values.shape[1]), dtype=values.dtype)
+
+    # sliding_window_view returns (windows x channels x samples), keep samples on axis 1
+    windows = sliding_window_view(values, window_size, axis=0)[::step]
+    return windows.swapaxes(1, 2)
+
+class Spectrum:
+    """
+    Spectral stage shared by all the frequency-domain features. A single batched real FFT is computed per
+    window and channel (split into non-overlapping segments of nperseg samples when requested) and cached,
+    so medFreq, relativePower and plotFreq all read from the same transform (coherence, which needs several
+    segments per window, builds its own unless the segmentation is the same).
+
+    Attributes:
+    -----------------------------------------------------------------
+    -fs: sampling frequency of the signal (Hz).
+    -nperseg: nb of samples in each segment.
+    -freqs: array containing the frequency axis (Hz).
+    -fft: complex array of shape (windows x segments x frequencies x channels).
+    -count: class attribute, total nb of FFTs (one per window and channel) computed so far.
+
+    """
+    count = 0
+
+    def __init__(self, windows, fs, nperseg=None):
+        n_windows, window_size, n_channels = windows.shape
+        self.fs = fs
+        self.nperseg = window_size if nperseg is None else min(nperseg, window_size)
+
+        # Split each window into non-overlapping segments (the remainder is dropped)
+        n_segments = window_size // self.nperseg
+        segments = windows[:, : (n_segments * self.nperseg)].reshape(n_windows, n_segments, self.nperseg, n_channels)
+
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / fs)
+        self.fft = rfft(segments, axis=2)    # single precision for float32 windows (numpy's rfft computes in double)
+        self._psd = None
+
+        Spectrum.count += n_windows * n_channels
+
+    @property
+    def psd(self):
+        """
+        Power of each frequency bin averaged over segments, array of shape (windows x frequencies x channels).
+        """
+        if self._psd is None:
+            self._psd = np.mean(np.square(np.abs(self.fft)), axis=1)
+        return self._psd
+
+    def crossSpectrum(self, i, j):
+        """
+        Cross-spectrum between channels i and j averaged over segments, array of shape (windows x frequencies).
+        """
+        return np.mean(self.fft[..., i] * np.conj(self.fft[..., j]), axis=1)
 
 def RMS(data):
-    return None
+    """
+    Root mean square of each window and channel.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels).
+
+    Returns:
+    -----------------------------------------------------------------
+    -rms: array of shape (windows x channels).
 
-def ZCR(data):
-    return None
+    """
+    return np.sqrt(np.mean(np.square(data), axis=1))
 
-def medFreq(data):
-    return None
+def ZCR(data, fs=1000):
+    """
+    Zero-crossing rate (crossings per second) of each window and channel.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels).
+    -fs: sampling frequency of the signal, default: 1000 Hz
+
+    Returns:
+    -----------------------------------------------------------------
+    -zcr: array of shape (windows x channels).
+
+    """
+    signs = np.signbit(data)
+    crossings = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1)
+    return crossings * fs / data.shape[1]
+
+def medFreq(data, fs=1000):
+    """
+    Median frequency (Hz) of each window and channel, i.e. the frequency that splits the power spectrum in two halves of equal power.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels), or Spectrum already computed for those windows.
+    -fs: sampling frequency of the signal, default: 1000 Hz. Ignored if data is a Spectrum.
+
+    Returns:
+    -----------------------------------------------------------------
+    -mf: array of shape (windows x channels).
+
+    """
+    spectrum = data if isinstance(data, Spectrum) else Spectrum(data, fs)
+    cumpower = np.cumsum(spectrum.psd, axis=1)
+    half = cumpower[:, -1:, :] / 2
+    idx = np.count_nonzero(cumpower < half, axis=1)
+    return spectrum.freqs[np.minimum(idx, len(spectrum.freqs) - 1)]
 
 def variance(data):
-    return None
+    """
+    Variance of each window and channel.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels).
+
+    Returns:
+    -----------------------------------------------------------------
+    -var: array of shape (windows x channels).
+
+    """
+    return np.var(data, axis=1)
+
+def channelPairs(channels, pairs='all'):
+    """
+    Resolves a set of channel pairs into channel indexes and column names.
+
+    Args:
+    -----------------------------------------------------------------
+    -channels: sequence containing the channel names.
+    -pairs: list of length-2 sequences of channel names or indexes (e.g. homologous left/right muscles), or str 'all' to select all pairs, default='all'
 
-def coherence(data):
-    return None
+    Returns:
+    -----------------------------------------------------------------
+    -first: array containing the index of the first channel of each pair.
+    -second: array containing the index of the second channel of each pair.
+    -names: list containing the name of each pair, 'channel1-channel2'.
+
+    """
+    channels = list(channels)
+    if isinstance(pairs, str) and pairs == 'all':
+        pairs = list(itertools.combinations(range(len(channels)), 2))
+
+    first, second, names = [], [], []
+    for a, b in pairs:
+        i = a if isinstance(a, (int, np.integer)) else channels.index(a)
+        j = b if isinstance(b, (int, np.integer)) else channels.index(b)
+        first.append(i)
+        second.append(j)
+        names.append(f"{channels[i]}-{channels[j]}")
+
+    return np.array(first, dtype=int), np.array(second, dtype=int), names
+
+def coherence(data, pairs, fs=1000, band=COH_BAND, nperseg=None):
+    """
+    Magnitude-squared coherence of each window and channel pair, averaged over a frequency band. All pairs are
+    computed in one vectorized pass from the per-channel FFTs of the Spectrum, no FFT is run per pair.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels), or Spectrum already computed for those windows.
+    -pairs: tuple (first, second) of index arrays as returned by channelPairs.
+    -fs: sampling frequency of the signal, default: 1000 Hz. Ignored if data is a Spectrum.
+    -band: length-2 sequence, limits (Hz) of the frequency band, default: COH_BAND
+    -nperseg: int, nb of samples in each segment, default: window size // COH_SEGMENTS. Ignored if data is a Spectrum.
+
+    Returns:
+    -----------------------------------------------------------------
+    -coh: array of shape (windows x pairs).
+
+    """
+    if isinstance(data, Spectrum):
+        spectrum = data
+    else:
+        spectrum = Spectrum(data, fs, nperseg or max(1, data.shape[1] // COH_SEGMENTS))
+    first, second = pairs[0], pairs[1]
+
+    in_band = (spectrum.freqs >= band[0]) & (spectrum.freqs <= band[1])
+    fft = spectrum.fft[:, :, in_band, :]
+    psd = spectrum.psd[:, in_band, :]
+
+    # Cross-spectra of all pairs at once (windows x frequencies x pairs). Computed in real arithmetic on contiguous
+    # arrays: the complex product may be vectorized with fused multiply-adds depending on the memory layout, which
+    # would make the rounding depend on the nb of windows in the block (see online.OnlineDetector)
+    a, b = (np.ascontiguousarray(fft[..., channels]) for channels in (first, second))
+    cross_re = np.mean(a.real * b.real + a.imag * b.imag, axis=1)
+    cross_im = np.mean(a.imag * b.real - a.real * b.imag, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        msc = (np.square(cross_re) + np.square(cross_im)) / (psd[..., first] * psd[..., second])
+    return np.mean(msc, axis=1)
 
 def iEMG(data):
-    return None
+    """
+    Integrated EMG (sum of absolute values) of each window and channel.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels).
+
+    Returns:
+    -----------------------------------------------------------------
+    -iemg: array of shape (windows x channels).
 
-def relativePower(data):
-    return None
+    """
+    return np.sum(np.abs(data), axis=1)
 
-def extractFeatures(data, sliding_window, overlap, fs=1000):
-    window_size = sliding_window * fs   # nb of samples in each window
-    overlap_size = overlap * fs         # nb of overlapping samples in each window
-    start = 0
+def relativePower(data, fs=1000, band=RP_BAND):
+    """
+    Power within a frequency band relative to the total power of each window and channel.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: array of shape (windows x samples x channels), or Spectrum already computed for those windows.
+    -fs: sampling frequency of the signal, default: 1000 Hz. Ignored if data is a Spectrum.
+    -band: length-2 sequence, limits (Hz) of the frequency band, default: RP_BAND
+
+    Returns:
+    -----------------------------------------------------------------
+    -rp: array of shape (windows x channels).
+
+    """
+    spectrum = data if isinstance(data, Spectrum) else Spectrum(data, fs)
+    freqs, psd = spectrum.freqs, spectrum.psd
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return psd[:, in_band, :].sum(axis=1) / psd.sum(axis=1)
+
+def runningFeatures(data, window_size, step, fs=1000, chunk_size=2**20):
+    """
+    Computes RMS, ZCR, variance and iEMG of every sliding window from running sums instead of reducing each
+    window. The signal is summed once in blocks of gcd(window_size, step) samples and each window is obtained
+    as the difference of two cumulative sums, so its cost no longer depends on the overlap. The values match
+    the batch definitions (RMS, ZCR, variance, iEMG) within float tolerance.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: dataframe or array (samples x channels) containing the signal.
+    -window_size: int, nb of samples in each window.
+    -step: int, nb of samples between the starts of two consecutive windows.
+    -fs: sampling frequency of the signal, default: 1000 Hz
+    -chunk_size: int, approximate nb of samples summed at once (bounds the memory used by temporary arrays), default: 2**20
+
+    Returns:
+    -----------------------------------------------------------------
+    -results: dict mapping each name in RUNNING_FEATURES to an array of shape (windows x channels).
+
+    """
+    values = np.asarray(data)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    n_samples, n_channels = values.shape
+
+    if n_samples < window_size:
+        return {name: np.empty((0, n_channels)) for name in RUNNING_FEATURES}
+
+    n_windows = (n_samples - window_size) // step + 1
+    block = math.gcd(window_size, step)         # nb of samples in each summed block
+    span = window_size // block                 # nb of blocks in each window
+    n_blocks = (n_windows - 1) * (step // block) + span
+
+    # Sums are taken on the channel-centered signal to avoid cancellation in the variance
+    mu = values.mean(axis=0)
+
+    # Running sums (one leading row of zeros): sum, sum of squares, sum of absolute values, sign changes
+    s1 = np.zeros((n_blocks + 1, n_channels))
+    s2 = np.zeros((n_blocks + 1, n_channels))
+    sabs = np.zeros((n_blocks + 1, n_channels))
+    changes = np.zeros((n_blocks + 1, n_channels), dtype=np.int64)
+
+    blocks_per_chunk = max(1, chunk_size // block)
+    for b0 in range(0, n_blocks, blocks_per_chunk):
+        b1 = min(b0 + blocks_per_chunk, n_blocks)
+        raw = values[(b0 * block) : (b1 * block + 1)]
+        seg = raw[: (b1 - b0) * block].reshape(b1 - b0, block, n_channels)
+
+        centered = seg - mu
+        s1[(b0 + 1) : (b1 + 1)] = centered.sum(axis=1)
+        s2[(b0 + 1) : (b1 + 1)] = np.square(centered).sum(axis=1)
+        sabs[(b0 + 1) : (b1 + 1)] = np.abs(seg).sum(axis=1)
+
+        # Sign change between sample i and i+1 is counted in the block of sample i
+        signs = np.signbit(raw)
+        change = np.zeros(((b1 - b0) * block, n_channels), dtype=bool)
+        change[: (len(raw) - 1)] = signs[1:] != signs[:-1]
+        changes[(b0 + 1) : (b1 + 1)] = change.reshape(b1 - b0, block, n_channels).sum(axis=1)
+
+    for running in (s1, s2, sabs, changes):
+        np.cumsum(running, axis=0, out=running)
+
+    first = np.arange(n_windows) * (step // block)
+    starts = np.arange(n_windows) * step
+
+    mean_c = (s1[first + span] - s1[first]) / window_size
+    var = np.maximum((s2[first + span] - s2[first]) / window_size - np.square(mean_c), 0)
+
+    # The last sign change of each window's last block involves the first sample after the window
+    last = starts + window_size - 1
+    signs_last = np.signbit(values[last])
+    signs_next = np.signbit(values[np.minimum(last + 1, n_samples - 1)])
+    outside = (signs_last != signs_next) & (last + 1 < n_samples)[:, np.newaxis]
+    crossings = changes[first + span] - changes[first] - outside
+
+    results = {'RMS': np.sqrt(var + np.square(mean_c + mu)),
+               'ZCR': crossings * fs / window_size,
+               'VAR': var,
+               'iEMG': sabs[first + span] - sabs[first]}
+    return results
+
+def acmActivity(acm, window_size, step, fs=1000):
+    """
+    Motion activity of each sliding window, computed from the accelerometer channels in one cheap vectorized pass:
+    the vector magnitude of each sensor (sqrt(x² + y² + z²), which removes the dependence on the orientation) is
+    reduced to its standard deviation within each window (which removes gravity) with running sums (see
+    runningFeatures), and the most active sensor gives the activity of the window. The ACM channels are subsampled
+    by up to ACM_STRIDE samples (a divisor of window_size and step, so the windows are unchanged).
+
+    Args:
+    -----------------------------------------------------------------
+    -acm: dataframe or array (samples x ACM channels) containing the accelerometer data, e.g. as selected by readHDF5(modality='acm').
+          The channels are expected in the order of load_data.C3D_ORDER (x of every sensor, then y, then z). If their nb is
+          not a multiple of 3, every channel is treated as a separate sensor.
+    -window_size: int, nb of samples in each window.
+    -step: int, nb of samples between the starts of two consecutive windows.
+    -fs: sampling frequency of the signal, default: 1000 Hz
+
+    Returns:
+    -----------------------------------------------------------------
+    -activity: array of shape (windows,) containing the activity of each window.
+
+    """
+    values = np.asarray(acm)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+
+    stride = math.gcd(math.gcd(window_size, step), ACM_STRIDE)
+    values = values[::stride]
+
+    n_sensors = values.shape[1] // 3
+    if values.shape[1] % 3 == 0:
+        x, y, z = values[:, :n_sensors], values[:, n_sensors:(2 * n_sensors)], values[:, (2 * n_sensors):]
+        magnitude = np.sqrt(x * x + y * y + z * z)
+    else:
+        magnitude = values
+    var = runningFeatures(magnitude, window_size // stride, step // stride, fs / stride)['VAR']
+    return np.sqrt(var.max(axis=1)) if var.size else np.empty(len(var))
+
+def extractFeatures(data, sliding_window, overlap, fs=1000, block_size=1024, incremental=False, nperseg=None, count_ffts=False, pairs=None,
+                    acm=None, threshold=ACM_THRESHOLD):
+    """
+    Computes the features of every sliding window and channel. The windows are never copied: a strided view
+    is built once over the whole signal and every feature is computed as a batched array reduction over
+    blocks of windows. The signal is never upcast: float32 data (see load_data.SIGNAL_DTYPE) is reduced and
+    transformed in float32 and the features are returned in the dtype of the data.
+
+    Args:
+    -----------------------------------------------------------------
+    -data: dataframe (samples x channels) containing the data, with timestamps as indexes.
+    -sliding_window: duration of each window (s).
+    -overlap: duration of the overlap between two consecutive windows (s).
+    -fs: sampling frequency of the signal, default: 1000 Hz
+    -block_size: int, nb of windows processed at once (bounds the memory used by temporary arrays), default: 1024
+    -incremental: bool, whether to compute RMS, ZCR, VAR and iEMG from running sums (see runningFeatures). Recommended for large overlaps, default: False
+    -nperseg: int, nb of samples in each segment of the spectrum used by MF and RP (see Spectrum). None to use the whole window, default: None
+    -count_ffts: bool, whether to print the nb of FFTs computed (there should be exactly one per window and channel, two if pairs is given), default: False
+    -pairs: channel pairs for which the coherence is computed (see channelPairs), or None to skip it, default: None.
+            The coherence needs several segments per window: it is computed from its own segmented spectrum (window size //
+            COH_SEGMENTS samples per segment, one FFT per window and channel), so requesting it does not change MF and RP.
+    -acm: dataframe or array (samples x ACM channels) containing the accelerometer data of the same samples as data, or None to
+          compute the features of every window, default: None. If given, the features are computed in two stages (cascade):
+          the activity of every window is computed first from the ACM channels (see acmActivity), then the EMG features
+          (including the spectral ones and the coherence) are only computed for the windows whose activity is at least threshold.
+    -threshold: ACM activity below which a window is skipped (cascade mode only), default: ACM_THRESHOLD
+
+    Returns:
+    -----------------------------------------------------------------
+    -features: dict mapping each channel name to a dataframe (windows x features), indexed by the start time of each window.
+               If pairs is given, features['CH'] is a dataframe (windows x pairs) containing the coherence of each pair.
+               In cascade mode, the features of skipped windows are NaN and features['ACM'] is a dataframe containing the
+               'activity' of each window and whether it was 'skipped'.
+
+    """
+    window_size = int(round(sliding_window * fs))   # nb of samples in each window
+    overlap_size = int(round(overlap * fs))         # nb of overlapping samples in each window
+    step = window_size - overlap_size
+    if step <= 0:
+        raise ValueError("The overlap must be shorter than the sliding window.")
+
+    windows = slidingWindows(data, window_size, step)
+    n_windows, _, n_channels = windows.shape
+    dtype = windows.dtype if np.issubdtype(windows.dtype, np.floating) else np.float64
+
+    # Windows whose EMG features are computed (all of them, unless the ACM gate skips the quiet ones)
+    if acm is not None:
+        activity = acmActivity(acm, window_size, step, fs)[:n_windows]
+        selected = np.flatnonzero(activity >= threshold)
+    else:
+        selected = np.arange(n_windows)
+
+    if isinstance(data, pd.DataFrame):
+        channels = data.columns
+        index = data.index[::step][:n_windows]
+    else:
+        channels = range(n_channels)
+        index = np.arange(n_windows) * step
+
+    if pairs is not None:
+        pairs = channelPairs(channels, pairs)
+        coher = np.full((n_windows, len(pairs[2])), np.nan, dtype=dtype)
+        coh_nperseg = max(1, window_size // COH_SEGMENTS)
 
     # Initialize features
-    rms = []
-    zcr = []
-    mf = []
-    var = []
-    coher = []
-    iemg = []
-    rpower = []
-
-    while start + window_size <= len(data):
-        current_window = data.iloc[start : (start + window_size)]
-
-        rms = rms.append(RMS(current_window))
-        zcr = zcr.append(ZCR(current_window))
-        mf = mf.append(medFreq(current_window))
-        var = var.append(variance(current_window))
-        coher = coher.append(coherence(current_window)) # TODO: adapt nb of columns, it is NOT in all channels
-        iemg = iemg.append(iEMG(current_window))
-        rpower = rpower.append(relativePower(current_window))
-
-        start = (start + window_size) - overlap_size
-
-    features_dict = {'RMS': rms, 
-                     'ZCR': zcr,
-                     'MF': mf,
-                     'VAR': var,
-                     'CH': coher,
-                     'iEMG': iemg,
-                     'RP': rpower}
-    
-    features = pd.DataFrame(features_dict)
+    results = {name: np.full((n_windows, n_channels), np.nan, dtype=dtype) for name in FEATURES}
+    if incremental:
+        for name, values in runningFeatures(data, window_size, step, fs).items():
+            results[name][selected] = values[selected]
+
+    ffts_before = Spectrum.count
+
+    for first in range(0, len(selected), block_size):
+        rows = selected[first : (first + block_size)]
+        # Contiguous runs of windows stay views, gated windows are gathered one block at a time
+        if acm is None:
+            rows = slice(rows[0], rows[-1] + 1)
+        block = windows[rows]
+        spectrum = Spectrum(block, fs, nperseg)
+
+        if not incremental:
+            results['RMS'][rows] = RMS(block)
+            results['ZCR'][rows] = ZCR(block, fs)
+            results['VAR'][rows] = variance(block)
+            results['iEMG'][rows] = iEMG(block)
+        results['MF'][rows] = medFreq(spectrum)
+        results['RP'][rows] = relativePower(spectrum)
+        if pairs is not None:
+            # Own segmented spectrum, unless MF and RP already use the same segments
+            coher[rows] = coherence(spectrum if spectrum.nperseg == coh_nperseg else block, pairs, fs, nperseg=coh_nperseg)
+
+    if count_ffts:
+        ffts = Spectrum.count - ffts_before
+        message(f"FFTs computed: {ffts} ({len(selected)} windows x {n_channels} channels)", ffts=ffts, windows=len(selected))
+    if acm is not None and n_windows:
+        skipped = n_windows - len(selected)
+        message(f"ACM cascade: {skipped} of {n_windows} windows skipped, {100 * skipped / n_windows:.1f}% of the EMG feature compute avoided",
+                skipped=skipped, windows=n_windows)
+
+    features = {}
+    for c, channel in enumerate(channels):
+        features[channel] = pd.DataFrame({name: results[name][:, c] for name in FEATURES}, index=index)
+
+    if pairs is not None:
+        features['CH'] = pd.DataFrame(coher, index=index, columns=pairs[2])
+    if acm is not None:
+        skipped = np.ones(n_windows, dtype=bool)
+        skipped[selected] = False
+        features['ACM'] = pd.DataFrame({'activity': activity, 'skipped': skipped}, index=index)
+
     return features
+
+def streamFeatures(patient, date, shift, batch, folder, modality, hp_cutoff, notch_cutoffs, sliding_window, overlap, fs=1000, chunk_size=None, **kwargs):
+    """
+    Streaming version of readHDF5(..., hrIdx=0) -> preprocess -> extractFeatures. The batch is read one hour (or one
+    chunk) at a time, the filter state and the samples of the last incomplete window are carried across chunk
+    boundaries, and the features are yielded as soon as their window is complete. Peak memory does not depend on
+    the nb of hours in the batch and the features are the same as those of the in-memory path, including the
+    windows that cross hour boundaries.
+
+    Args:
+    -----------------------------------------------------------------
+    -patient, date, shift, batch, folder, modality: recording to process (see readHDF5).
+    -hp_cutoff: int, cutoff frequency (Hz) for the highpass filter.
+    -notch_cutoffs: length-2 sequence, cutoff frequencies (Hz) for bandstop filter.
+    -sliding_window: duration of each window (s).
+    -overlap: duration of the overlap between two consecutive windows (s).
+    -fs: sampling frequency of the downsampled data, default: 1000 Hz
+    -chunk_size: int, nb of (original) samples read at once. None to read one hour at a time, default: None
+    -kwargs: other arguments passed to extractFeatures (e.g. incremental, pairs).
+
+    Yields
+    -----------------------------------------------------------------
+    -features: dict mapping each channel name to a dataframe (windows x features) containing the windows completed by the last chunk (see extractFeatures).
+
+    """
+    window_size = int(round(sliding_window * fs))
+    step = window_size - int(round(overlap * fs))
+
+    pipeline = FilterPipeline(fs).highpass(hp_cutoff).notch(notch_cutoffs)
+    zi = None
+    tail = None     # filtered samples that do not belong to a complete window yet
+
+    for data, _ in iterHDF5(patient, date, shift, batch, folder, modality, chunk_size):
+        filtered, zi = pipeline.applyStateful(data, zi)
+        buffer = filtered if tail is None else pd.concat([tail, filtered])
+
+        n_windows = (len(buffer) - window_size) // step + 1 if len(buffer) >= window_size else 0
+        if n_windows > 0:
+            yield extractFeatures(buffer, sliding_window, overlap, fs, **kwargs)
+        tail = buffer.iloc[(n_windows * step):]
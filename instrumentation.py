@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import functools
+import pandas as pd
+from timeit import default_timer as timer
+try:
+    import resource
+except ImportError:     # Not available on Windows
+    resource = None
+
+# Sinks receiving the progress messages and stage records (see enable/disable)
+_sinks = []
+
+# Stages currently running in this process, innermost last
+_stack = []
+
+def _peakRSS():
+    """
+    High-water mark of the resident set size of the process (bytes), since the last _resetPeakRSS.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _resetPeakRSS():
+    # Linux only: elsewhere the peak RSS of a stage is the peak of the whole process so far
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _size(data):
+    """
+    Nb of samples (rows) and bytes of an array or dataframe.
+    """
+    if isinstance(data, pd.DataFrame):
+        return len(data), int(data.memory_usage(index=False).sum())
+    if isinstance(data, pd.Series):
+        return len(data), int(data.memory_usage(index=False))
+    return len(data), int(getattr(data, 'nbytes', 0))
+
+class LogSink:
+    """
+    Writes the progress messages and a one-line summary of each stage to a text stream (stdout by default, as print).
+
+    Attributes:
+    -------------------------------
+    -stream: file-like object, or None for the current sys.stdout at each write (as print, so that redirecting or
+             capturing stdout after the sink is created still works).
+    -records: bool, whether to write the stage summaries (False to only write the progress messages).
+
+    """
+    def __init__(self, stream=None, records=True):
+        self.stream = stream
+        self.records = records
+
+    def message(self, text, fields):
+        print(text, file=self.stream or sys.stdout)
+
+    def record(self, record):
+        if not self.records:
+            return
+        hour = f" (hour {record['hour']})" if record.get('hour') is not None else ""
+        text = f"[{record['stage']}{hour}] {record['wall']:.2f} s"
+        if record['cpu'] is not None:
+            text += f", CPU {record['cpu']:.2f} s"
+        if record['peak_rss'] is not None:
+            text += f", peak RSS {record['peak_rss'] / 2**20:.0f} MB"
+        if record['samples']:
+            text += f", {record['samples']} samples ({record['bytes'] / 2**20:.1f} MB)"
+        print(text, file=self.stream or sys.stdout)
+
+    def close(self):
+        (self.stream or sys.stdout).flush()
+
+class JSONLinesSink:
+    """
+    Appends every stage record and progress message as one JSON object per line to a file (easy to load with
+    pd.read_json(file, lines=True)).
+
+    Attributes:
+    -------------------------------
+    -file: path of the .jsonl file.
+
+    """
+    def __init__(self, file):
+        self.file = file
+        self._f = open(file, 'a')
+
+    def message(self, text, fields):
+        self._f.write(json.dumps({'event': 'message', 'text': text, **fields}, default=str) + '\n')
+
+    def record(self, record):
+        self._f.write(json.dumps({'event': 'stage', **record}, default=str) + '\n')
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+class Collector:
+    """
+    Keeps the stage records in memory, to summarize them at the end of a run (see breakdown).
+
+    Attributes:
+    -------------------------------
+    -records: list of dicts, one per completed stage.
+    -messages: list of (text, fields) progress messages.
+
+    """
+    def __init__(self):
+        self.records = []
+        self.messages = []
+
+    def message(self, text, fields):
+        self.messages.append((text, fields))
+
+    def record(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+    def breakdown(self, by='stage'):
+        """
+        Summary of the records grouped by stage (by='stage') or by stage and hour (by=['stage', 'hour']): nb of calls,
+        total wall and CPU times (s), maximum peak RSS (MB), total samples and bytes (MB) processed.
+        """
+        if not self.records:
+            return pd.DataFrame()
+        records = pd.DataFrame(self.records)
+        if 'hour' in records:
+            records['hour'] = records['hour'].astype('Int64')
+        summary = records.groupby(by, dropna=False, sort=False).agg(calls=('wall', 'size'), wall=('wall', 'sum'), cpu=('cpu', 'sum'),
+                                                                    peak_rss=('peak_rss', 'max'), samples=('samples', 'sum'), bytes=('bytes', 'sum'))
+        summary['peak_rss'] /= 2**20
+        summary['bytes'] /= 2**20
+        return summary.rename(columns={'peak_rss': 'peak_rss_mb', 'bytes': 'mb'})
+
+    def report(self, by='stage'):
+        """
+        Prints the per-stage breakdown (see breakdown).
+        """
+        with pd.option_context('display.float_format', '{:.2f}'.format, 'display.width', 200):
+            print(self.breakdown(by))
+
+def enable(*sinks):
+    """
+    Sends the progress messages and stage records to the given sinks (replacing the current ones).
+    """
+    _sinks[:] = sinks
+
+def disable():
+    """
+    Closes the current sinks and disables the instrumentation: stages are not measured and messages are dropped.
+    """
+    for sink in _sinks:
+        sink.close()
+    _sinks.clear()
+
+def enabled():
+    """
+    Whether the stages are measured: at least one sink consumes the stage records (a LogSink with records=False only
+    prints the progress messages, so it does not turn the measurements on).
+    """
+    # Collector.records is the list of records (possibly still empty): only an explicit False opts out
+    return any(getattr(sink, 'records', True) is not False for sink in _sinks)
+
+def message(text, **fields):
+    """
+    Progress message (replaces print): written by the log sink, kept with the fields of the enclosing stage by the others.
+    """
+    if not _sinks:
+        return
+    if _stack:
+        fields = {**_stack[-1].context, **fields}
+    for sink in _sinks:
+        sink.message(text, fields)
+
+def emit(stage, wall, cpu=None, peak_rss=None, samples=0, nbytes=0, **context):
+    """
+    Sends a stage record measured elsewhere (e.g. in a worker process, whose stages are not seen by the sinks of this process).
+    """
+    if not enabled():
+        return
+    record = {'stage': stage, **context, 'wall': wall, 'cpu': cpu, 'peak_rss': peak_rss, 'samples': samples, 'bytes': nbytes}
+    for sink in _sinks:
+        sink.record(record)
+
+class stage:
+    """
+    Measures a stage of the pipeline, as a context manager or a decorator:
+
+        with stage('readHDF5', hour=i) as s:
+            data = ...
+            s.count(data)
+
+        @stage('preprocess')
+        def preprocess(...): ...
+
+    records the wall time, CPU time, peak RSS, and samples/bytes processed (see count) of the stage and sends them to
+    the sinks when it ends. The context (e.g. hour) is inherited by the nested stages and messages. When no sink
+    consumes the records (see enabled), nothing is measured: in particular, the peak RSS of the process is not reset.
+
+    Attributes:
+    -------------------------------
+    -name: str, name of the stage.
+    -context: dict, fields added to the record (e.g. hour).
+    -record: dict, record of the stage once it ended (None if disabled).
+
+    """
+    def __init__(self, name, **context):
+        self.name = name
+        self.context = context
+        self.record = None
+        self.samples = 0
+        self.nbytes = 0
+
+    def count(self, data=None, samples=None, nbytes=None):
+        """
+        Adds the samples (rows) and bytes of data (array or dataframe), or the given counts, to the processed amounts.
+        """
+        if not self.active:
+            return
+        if data is not None:
+            samples, nbytes = _size(data)
+        self.samples += samples or 0
+        self.nbytes += nbytes or 0
+
+    def __enter__(self):
+        self.active = enabled()
+        if not self.active:
+            return self
+        if _stack:
+            parent = _stack[-1]
+            self.context = {**parent.context, **self.context}
+            # The peak reached so far belongs to the enclosing stages before it is reset
+            parent._peak = max(parent._peak or 0, _peakRSS() or 0)
+        _stack.append(self)
+        _resetPeakRSS()
+        self._peak = None
+        self._start = timer()
+        self._cpu = os.times()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        end, cpu = timer(), os.times()
+        _stack.pop()
+        peak = _peakRSS()
+        if peak is not None:
+            peak = max(peak, self._peak or 0)
+            if _stack:
+                _stack[-1]._peak = max(_stack[-1]._peak or 0, peak)
+        self.record = {'stage': self.name, **self.context, 'wall': end - self._start,
+                       'cpu': (cpu.user + cpu.system) - (self._cpu.user + self._cpu.system),
+                       'peak_rss': peak, 'samples': self.samples, 'bytes': self.nbytes}
+        if exc[0] is not None:
+            self.record['error'] = exc[0].__name__
+        for sink in _sinks:
+            sink.record(self.record)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with stage(self.name, **self.context):
+                return func(*args, **kwargs)
+        return wrapper
+
+def addArguments(parser):
+    """
+    Adds the instrumentation options to the parser of a command-line script (see fromArguments).
+    """
+    parser.add_argument('--profile', action='store_true', help="Print a per-stage breakdown (time, CPU, peak RSS, samples) at the end of the run")
+    parser.add_argument('--trace', type=str, default=None, help="JSON lines file where every stage record is appended")
+    parser.add_argument('--quiet', action='store_true', help="Do not print the progress messages")
+
+def fromArguments(args):
+    """
+    Enables the sinks requested on the command line (see addArguments).
+
+    Returns:
+    -----------------------------------------------------------------
+    -collector: Collector to report at the end of the run, or None if --profile was not given.
+
+    """
+    collector = Collector() if args.profile else None
+    sinks = [] if args.quiet else [LogSink(records=False)]
+    if args.trace is not None:
+        sinks.append(JSONLinesSink(args.trace))
+    if collector is not None:
+        sinks.append(collector)
+    enable(*sinks)
+    return collector
+
+# By default, progress messages are printed (as before) and stages are not summarized
+enable(LogSink(records=False))
@@ -1,12 +1,128 @@
+import json
+from collections import OrderedDict
 import pandas as pd
 import c3d
 import warnings
 import numpy as np
+from pathlib import Path
 from config import temp_path, perm_path # type: ignore
-from TSGv3 import generate_timestamps   # type: ignore
+from TSGv3 import generate_timestamps, TimeAxis   # type: ignore
+from instrumentation import stage, message         # type: ignore
 
 warnings.filterwarnings("ignore", module="c3d.c3d")
 
+# Order of the 32 analog channels of a Cometa C3D file (EMG channels first, then ACM)
+C3D_ORDER = [0, 4, 8, 12, 16, 20, 24, 28,
+             1, 5, 9, 13, 17, 21, 25, 29,
+             2, 6, 10, 14, 18, 22, 26, 30,
+             3, 7, 11, 15, 19, 23, 27, 31]
+
+# Channels (after removing 'sec') of each modality
+MODALITY_CHANNELS = {'emg': slice(0, 8), 'acm': slice(8, None), 'both': slice(None)}
+
+# Default dtype of the signal arrays (EMG/ACM channels) across the pipeline. The time axes ('sec', time-stamps) stay
+# float64/int64. float32 halves the memory of every stage; the filters keep float64 coefficients and states (see
+# processing_tools.FilterPipeline), so the loss of accuracy is that of storing the samples in float32.
+SIGNAL_DTYPE = np.float32
+
+def parseTimestamps(index):
+    """
+    Converts the time-stamps stored as index into a DatetimeIndex. Files written by the current TSG store them as
+    int64 nanoseconds (no parsing needed); older files store them as strings in the format '%d-%b-%Y %H:%M:%S.%f'.
+
+    Args
+    -------------------------------
+    -index: index containing the time-stamps (datetime, int64 nanoseconds or strings).
+
+    Returns
+    -------------------------------
+    -timestamps: DatetimeIndex containing the time-stamps.
+
+    """
+    if isinstance(index, pd.DatetimeIndex):
+        return index
+    if pd.api.types.is_integer_dtype(index.dtype):
+        return pd.to_datetime(index, unit='ns')
+    return pd.to_datetime(index, format='%d-%b-%Y %H:%M:%S.%f')
+
+def hourKeys(store):
+    """
+    Lists the hours stored in an open HDF5 store and their layout: 'fixed' (one key 'Hour{i}' with all the columns, as
+    written by TSGv2) or 'table' (two compressed, queryable tables 'Hour{i}/emg' with 'sec' and the EMG channels and
+    'Hour{i}/acm' with the ACM channels, see TSGv4.write_hour).
+
+    Args
+    -------------------------------
+    -store: open pd.HDFStore.
+
+    Returns
+    -------------------------------
+    -hours: dict mapping each hour index (in increasing order) to its layout.
+
+    """
+    hours = {}
+    for key in store.keys():
+        parts = key.strip('/').split('/')
+        hours[int(parts[0][len('Hour'):])] = 'table' if len(parts) > 1 else 'fixed'
+    return dict(sorted(hours.items()))
+
+def hourAxis(store, i):
+    """
+    Builds the time axis of one hour stored in an open HDF5 store without loading its data: the start time and
+    sampling frequency come from the attributes written by TSG (or from the first two time-stamps of older files).
+
+    Args
+    -------------------------------
+    -store: open pd.HDFStore.
+    -i: int, hour index.
+
+    Returns
+    -------------------------------
+    -axis: TimeAxis of the hour.
+
+    """
+    key = f"Hour{i}/emg" if f"/Hour{i}/emg" in store else f"Hour{i}"
+    storer = store.get_storer(key)
+    nrows = storer.nrows if storer.is_table else storer.shape[0]
+
+    start_ns = getattr(storer.attrs, 'start_ns', None)
+    if start_ns is not None:
+        return TimeAxis(pd.Timestamp(start_ns), storer.attrs.fs, nrows)
+
+    first = parseTimestamps(store.select(key, start=0, stop=2).index)
+    return TimeAxis(first[0], 1e9 / (first[1] - first[0]).value, nrows)
+
+def readHour(store, i, modality, start=None, stop=None):
+    """
+    Reads rows [start, stop) of one hour (at the original sampling rate) with the 'sec' column and the channels of the
+    requested modality. With the table layout, only the tables of that modality are read from disk.
+
+    Args
+    -------------------------------
+    -store: open pd.HDFStore.
+    -i: int, hour index.
+    -modality: either 'emg', 'acm', or 'both'.
+    -start: int, first row to read, default: None (first row of the hour)
+    -stop: int, row after the last row to read, default: None (last row of the hour)
+
+    Returns
+    -------------------------------
+    -data: dataframe containing the 'sec' column and the selected channels, with the stored time-stamps as indexes.
+
+    """
+    if f"/Hour{i}/emg" in store:
+        emg = store.select(f"Hour{i}/emg", start=start, stop=stop, columns=['sec'] if modality == 'acm' else None)
+        if modality == 'emg':
+            return emg
+        acm = store.select(f"Hour{i}/acm", start=start, stop=stop)
+        return pd.concat([emg, acm], axis=1)
+
+    data = store.select(f"Hour{i}", start=start, stop=stop)
+    if modality != 'both':
+        channels = data.columns.drop('sec')[MODALITY_CHANNELS[modality]]
+        data = data[['sec'] + list(channels)]
+    return data
+
 class OriginalRecordingInfo:
     # TODO: write explanation of attributes
     def __init__(self, data, time):
@@ -17,7 +133,7 @@ class OriginalRecordingInfo:
         self.endTime = data.index[-1]
         self.duration = time[-1]
 
-def readHDF5(patient, date, shift, batch, hrIdx, folder, modality):
+def readHDF5(patient, date, shift, batch, hrIdx, folder, modality, startTime=None, endTime=None, step=2, dtype=SIGNAL_DTYPE):
     """
     Loads EMG-ACM data (with timestamps) from an HDF5 file and downsamples it
 
@@ -30,6 +146,13 @@ def readHDF5(patient, date, shift, batch, hrIdx, folder, modality):
     -hrIdx: int, hour index within the number of continuous recording hours. 0 to load complete recording.
     -folder: either 'temp' (temporary folder) or 'perm' (permanent folder), depending on the location of the file.
     -modality: either 'emg' (get EMG data only), 'acm' (get ACM data only), or 'both' (get both EMG and ACM data).
+    -startTime: start timestamp of the time interval to load (str 'yyyy-mm-dd HH:MM:SS' or datetime). None to load from the beginning, default: None
+    -endTime: end timestamp of the time interval to load. None to load until the end, default: None
+     Note: when an interval is given, only its rows are read from the file (their offsets are computed from the time axis of each hour, see hourAxis).
+     With the table layout (see hourKeys), only the columns of the requested modality are read.
+    -step: int, downsampling step (every step-th sample is kept, without anti-alias filter). 1 to load the full rate, e.g. to
+           decimate with an anti-alias filter in preprocess (factor=2), default: 2
+    -dtype: dtype of the returned channels, whatever the dtype stored in the file, default: SIGNAL_DTYPE (float32)
 
     Returns
     -------------------------------
@@ -37,69 +160,151 @@ def readHDF5(patient, date, shift, batch, hrIdx, folder, modality):
     -time_s: numpy array containing the equivalent time in seconds (to use as reference in the EMG and Motion Tools software). Note: should have the same nb of rows as data_ds
 
     """
-    print("Loading HDF5 data...")
+    with stage('readHDF5', hour=hrIdx) as s:
+        message("Loading HDF5 data...")
 
-    # Check the location of the file to load
-    if folder == 'temp':
-        path = temp_path    
-    elif folder == 'perm':
-        path = perm_path
+        # Check the location of the file to load
+        if folder == 'temp':
+            path = temp_path    
+        elif folder == 'perm':
+            path = perm_path
 
-    # Load .h5 file
-    dirpath = path / f"p{patient}"
-    file_name = f"p{patient}_{date}_{shift}_{batch}.h5"
-    file = dirpath / file_name
-
-    if hrIdx == 0:
-        dataframes = []
-        with pd.HDFStore(file, mode='r') as store:
-            keys = store.keys()
-            nkeys = len(keys)
-            for i in range(1, nkeys + 1):
-                df = pd.read_hdf(file, f"Hour{i}")
-                dataframes.append(df)
-        data = pd.concat(dataframes)      
-    else:
-        data = pd.read_hdf(file, f"Hour{hrIdx}")
+        # Load .h5 file
+        dirpath = path / f"p{patient}"
+        file_name = f"p{patient}_{date}_{shift}_{batch}.h5"
+        file = dirpath / file_name
 
-    # Extract time in seconds (for Cometa software)
-    time_s = data['sec'].values
-    time_s = time_s[::2]  # downsample by a factor of 2
-    
-    # Delete the 'sec' column from the dataframe
-    data = data.drop(columns=['sec'])
+        data_ds, time_s = loadHDF5(file, hrIdx, modality, startTime, endTime, step=step, dtype=dtype)
+        s.count(data_ds)
 
-    # Extract either only EMG, only ACM, or both
-    if modality == 'emg':
-        data = data.iloc[:, 0:8] 
-    elif modality == 'acm':
-        data = data.drop(data.columns[0:8], axis=1)
+    return data_ds, time_s
+
+def loadHDF5(file, hrIdx, modality, startTime=None, endTime=None, chunk_size=2**20, step=2, dtype=SIGNAL_DTYPE):
+    """
+    Loads EMG-ACM data (with timestamps) from an HDF5 file given by its path and downsamples it (see readHDF5).
+    The output is preallocated at its final (downsampled, modality-filtered) size from the metadata of each hour,
+    then every hour is read in chunks through a single store handle and written into it directly, so the peak
+    memory is about the output size plus one chunk.
+
+    Args
+    -------------------------------
+    -file: path of the .h5 file.
+    -hrIdx, modality, startTime, endTime, step, dtype: see readHDF5.
+    -chunk_size: int, nb of (original) samples read at once, default: 2**20
+
+    Returns
+    -------------------------------
+    -data_ds: dataframe containing the downsampled data.
+    -time_s: numpy array containing the equivalent time in seconds.
 
-    # Downsample data by a factor of 2
-    data_ds = data.iloc[::2, :].copy()
+    """
+    chunk_size = -(-chunk_size // step) * step
+    with pd.HDFStore(file, mode='r') as store:
+        hours = list(hourKeys(store)) if hrIdx == 0 else [hrIdx]
+
+        # Rows of each hour to read, keeping the downsampling phase of the full batch
+        ranges = []
+        offset = 0
+        for i in hours:
+            axis = hourAxis(store, i)
+            rows = axis.interval(startTime, endTime)
+            first = rows.start + (-(offset + rows.start)) % step
+            ranges.append((i, first, max(first, rows.stop)))
+            offset += len(axis)
+        nsamples = sum(-(-(stop - first) // step) for _, first, stop in ranges)
+
+        # Preallocate the output
+        empty = readHour(store, hours[0], modality, start=0, stop=0)
+        columns = empty.columns.drop('sec')
+        values, index, time_s = None, None, np.empty(nsamples)
 
-    # Convert 'Time' column to datetime 
-    data_ds.index = pd.to_datetime(data_ds.index, format='%d-%b-%Y %H:%M:%S.%f')
+        n = 0
+        for i, first, stop in ranges:
+            for start in range(first, stop, chunk_size):
+                chunk = readHour(store, i, modality, start=start, stop=min(start + chunk_size, stop)).iloc[::step]
+                timestamps = parseTimestamps(chunk.index)
+                if values is None:
+                    values = np.empty((nsamples, len(columns)), dtype=dtype)
+                    index = np.empty(nsamples, dtype=timestamps.dtype)
 
+                values[n:(n + len(chunk))] = chunk[columns].to_numpy()
+                index[n:(n + len(chunk))] = timestamps.values
+                time_s[n:(n + len(chunk))] = chunk['sec'].to_numpy()
+                n += len(chunk)
+
+    if values is None:
+        data_ds = empty.drop(columns=['sec']).astype(dtype)
+        data_ds.index = parseTimestamps(data_ds.index)
+        return data_ds, time_s
+
+    data_ds = pd.DataFrame(values, index=pd.DatetimeIndex(index, name=empty.index.name), columns=columns, copy=False)
     return data_ds, time_s
 
-def readC3D(patient, date, shift, batch, idx, folder, modality):
-    # TODO: write docstring
-    # TODO: time how long it takes to read the file and generate the timestamps
-    # TODO: make github repository private so that you can upload your code
-    print("Loading C3D data...")
+def iterHDF5(patient, date, shift, batch, folder, modality, chunk_size=None, dtype=SIGNAL_DTYPE):
+    """
+    Iterates over the EMG-ACM data of a full batch stored in an HDF5 file, one hour (or one fixed-size chunk) at a time,
+    so that only one chunk is held in memory. The chunks are downsampled exactly as readHDF5(..., hrIdx=0) would
+    (the decimation phase is kept across chunk boundaries), so concatenating them gives the same data.
+
+    Args
+    -------------------------------
+    -patient: patient's assigned number/code without the 'p'.
+    -date: date that appears in the file name in the format yyyymmdd.
+    -shift: either 'D' (day/morning shift), 'A' (afternoon shift), or 'N' (night shift) as appears in file name.
+    -batch: recording batch number as appears in file name.
+    -folder: either 'temp' (temporary folder) or 'perm' (permanent folder), depending on the location of the file.
+    -modality: either 'emg' (get EMG data only), 'acm' (get ACM data only), or 'both' (get both EMG and ACM data).
+    -chunk_size: int, nb of (original) samples read at once. None to read one hour at a time, default: None
+    -dtype: dtype of the returned channels, default: SIGNAL_DTYPE (float32)
 
+    Yields
+    -------------------------------
+    -data_ds: dataframe containing the downsampled chunk, with timestamps as datetime indexes.
+    -time_s: numpy array containing the equivalent time in seconds of the chunk.
+
+    """
     # Check the location of the file to load
     if folder == 'temp':
         path = temp_path    
     elif folder == 'perm':
         path = perm_path
 
-    # Load .c3d file
-    dirpath = path / f"p{patient}"
-    file_name = f"p{patient}_{date}_{shift}_{batch}_{idx}.c3d"
-    file = dirpath / file_name
+    file = path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
+
+    offset = 0  # nb of samples already read (before downsampling)
+    with pd.HDFStore(file, mode='r') as store:
+        for i in hourKeys(store):
+            nrows = len(hourAxis(store, i))
+            step = nrows if chunk_size is None else chunk_size
+
+            for start in range(0, nrows, step):
+                data = readHour(store, i, modality, start=start, stop=min(start + step, nrows))
 
+                # Downsample data by a factor of 2 (keeping the phase of the full batch)
+                first = (-offset) % 2
+                offset += len(data)
+                data = data.iloc[first::2]
+
+                time_s = data['sec'].values
+                data_ds = data.drop(columns=['sec']).astype(dtype)
+                data_ds.index = parseTimestamps(data_ds.index)
+                yield data_ds, time_s
+
+def readAnalogFrames(file, dtype=SIGNAL_DTYPE):
+    """
+    Reads the analog channels of a C3D file frame by frame with the c3d package, reorders them and removes the zero-padding.
+
+    Args
+    -------------------------------
+    -file: path of the .c3d file.
+    -dtype: dtype of the returned data, default: SIGNAL_DTYPE (float32)
+
+    Returns
+    -------------------------------
+    -data: dataframe (samples x channels) containing the analog data, columns ordered as in C3D_ORDER.
+    -analog_rate: float, analog sampling frequency (Hz).
+
+    """
     with open(file, 'rb') as c3dfile:
         frames = c3d.Reader(c3dfile)
         analog_samples = []
@@ -108,24 +313,118 @@ def readC3D(patient, date, shift, batch, idx, folder, modality):
             analog_samples.append(analog_transposed)
 
     # Concatenate the samples stored in frames
-    all_analog_samples = np.concatenate(analog_samples, axis=0)
+    all_analog_samples = np.concatenate(analog_samples, axis=0).astype(dtype, copy=False)
 
     # Convert to dataframe
     data_analog = pd.DataFrame(all_analog_samples, columns=frames.analog_labels)
 
     # Order columns
-    new_order = [0, 4, 8, 12, 16, 20, 24, 28,
-                1, 5, 9, 13, 17, 21, 25, 29,
-                2, 6, 10, 14, 18, 22, 26, 30,
-                3, 7, 11, 15, 19, 23, 27, 31]
-    data = data_analog.iloc[:, new_order]
+    data = data_analog.iloc[:, C3D_ORDER]
     data.columns = data.columns.str.strip().str.replace(r'\s+', ' ', regex=True)
 
     # Remove zero-padding
     data = data.apply(lambda x: np.trim_zeros(x, 'b'), axis=0)
 
+    return data, float(frames.analog_rate)
+
+def readAnalogBulk(file, dtype=SIGNAL_DTYPE):
+    """
+    Reads the analog channels of a C3D file as a single block: the data section is memory-mapped and viewed as
+    (frames x analog samples per frame x channels) using the header offsets, scaled with the ANALOG parameters in one
+    vectorized operation, reordered with one fancy-index and trimmed of the trailing zero-padding with one check
+    across channels. Gives the same data as readAnalogFrames. Files with DEC floats fall back to readAnalogFrames.
+
+    Args
+    -------------------------------
+    -file: path of the .c3d file.
+    -dtype: dtype of the returned data (the scaling is computed in this dtype), default: SIGNAL_DTYPE (float32)
+
+    Returns
+    -------------------------------
+    -data: dataframe (samples x channels) containing the analog data, columns ordered as in C3D_ORDER.
+    -analog_rate: float, analog sampling frequency (Hz).
+
+    """
+    with open(file, 'rb') as c3dfile:
+        reader = c3d.Reader(c3dfile)
+        is_float = reader.point_scale < 0
+        if is_float and reader.proc_type == 'DEC':
+            return readAnalogFrames(file, dtype)
+
+        # Explicit byte order (from the public processor type): MIPS files are big-endian, INTEL and DEC little-endian
+        endian = '>' if reader.proc_type == 'MIPS' else '<'
+        if is_float:
+            point_dtype = analog_dtype = np.dtype(endian + 'f4')
+        else:
+            point_dtype = np.dtype(endian + 'i2')
+            analog_dtype = np.dtype(endian + ('u2' if reader.analog_format_unsigned else 'i2'))
+
+        nchannels = reader.analog_used
+        per_frame = reader.analog_per_frame
+        gen_scale, scales, offsets = reader.get_analog_transform_parameters()
+        labels = reader.analog_labels
+        analog_rate = float(reader.analog_rate)     # stored as float32 in the header
+
+        # Layout of one frame: 4 words per point, then the analog samples of the frame
+        frame_dtype = np.dtype([('points', point_dtype, (4 * reader.point_used,)),
+                                ('analog', analog_dtype, (per_frame, nchannels))])
+        start = (reader.header.data_block - 1) * 512
+        nbytes = c3dfile.seek(0, 2) - start
+        nframes = min(reader.frame_count, nbytes // frame_dtype.itemsize)
+
+    frames = np.memmap(file, dtype=frame_dtype, mode='r', offset=start, shape=(nframes,))
+    raw = frames['analog'].reshape(nframes * per_frame, nchannels)
+
+    # Order columns and convert to physical units in one pass
+    analog = (raw[:, C3D_ORDER] - offsets[C3D_ORDER].astype(dtype)) * (scales[C3D_ORDER] * gen_scale).astype(dtype)
+    del frames
+
+    # Remove zero-padding (trailing samples that are zero in every channel)
+    nonzero = np.flatnonzero(np.any(analog != 0, axis=1))
+    nsamples = nonzero[-1] + 1 if len(nonzero) else 0
+
+    columns = pd.Index(np.asarray(labels)[C3D_ORDER]).str.strip().str.replace(r'\s+', ' ', regex=True)
+    data = pd.DataFrame(analog[:nsamples], columns=columns)
+
+    return data, analog_rate
+
+def readC3D(patient, date, shift, batch, idx, folder, modality, bulk=True, step=2, dtype=SIGNAL_DTYPE):
+    # TODO: write docstring
+    # TODO: time how long it takes to read the file and generate the timestamps
+    # TODO: make github repository private so that you can upload your code
+    # bulk: whether to read the analog block at once (readAnalogBulk) instead of frame by frame (readAnalogFrames)
+    # step: downsampling step (no anti-alias filter), 1 to keep the full rate and decimate in preprocess (see readHDF5)
+    # dtype: dtype of the returned channels, default: SIGNAL_DTYPE (float32)
+    with stage('readC3D', hour=idx) as s:
+        message("Loading C3D data...")
+
+        # Check the location of the file to load
+        if folder == 'temp':
+            path = temp_path    
+        elif folder == 'perm':
+            path = perm_path
+
+        # Load .c3d file
+        dirpath = path / f"p{patient}"
+        file_name = f"p{patient}_{date}_{shift}_{batch}_{idx}.c3d"
+        file = dirpath / file_name
+
+        data_ds, time_ds, rawInfo = loadC3D(file, modality, bulk, step, dtype)
+        s.count(data_ds)
+
+    return data_ds, time_ds, rawInfo
+
+def loadC3D(file, modality, bulk=True, step=2, dtype=SIGNAL_DTYPE):
+    """
+    Loads EMG-ACM data from a C3D file given by its path, generates its time-stamps and downsamples it (see readC3D).
+    """
+    if bulk:
+        data, analog_rate = readAnalogBulk(file, dtype)
+    else:
+        data, analog_rate = readAnalogFrames(file, dtype)
+
     # Generate time axis (units = seconds) as in EMG and Motion Tools
-    T = 1 / frames.analog_rate      # period in seconds
+    T = 1 / analog_rate             # period in seconds
     dur = (len(data) - 1) * T       # duration in seconds
     time = np.linspace(0.0, dur, num=len(data), dtype=float)
 
@@ -143,11 +442,247 @@ def readC3D(patient, date, shift, batch, idx, folder, modality):
     elif modality == 'acm':
         data = data.drop(data.columns[0:8], axis=1)
 
-    # Downsample data by a factor of 2
-    data_ds = data.iloc[::2, :].copy()
-    time_ds = time[::2]
+    # Downsample data by a factor of step (2 by default)
+    data_ds = data.iloc[::step, :].copy() if step > 1 else data
+    time_ds = time[::step]
 
-    # Convert timestamps to datetime 
-    data_ds.index = pd.to_datetime(data_ds.index, format='%d-%b-%Y %H:%M:%S.%f')
+    # Convert timestamps to datetime (already datetime, kept for older string time-stamps)
+    data_ds.index = parseTimestamps(data_ds.index)
     
-    return data_ds, time_ds, rawInfo
\ No newline at end of file
+    return data_ds, time_ds, rawInfo
+
+def exportRawStore(file, dtype=SIGNAL_DTYPE):
+    """
+    Exports a batch stored in an HDF5 file (any layout) to a raw channel store: one contiguous binary array
+    (channels x samples, at the original sampling rate) next to the .h5 file, plus a small JSON sidecar with the
+    channel labels, sampling frequency, start time and sample boundaries of each hour. The hours are copied one
+    at a time, so the whole batch is never held in memory.
+
+    Args
+    -------------------------------
+    -file: path of the .h5 file.
+    -dtype: dtype of the stored samples, default: SIGNAL_DTYPE (float32)
+
+    Returns
+    -------------------------------
+    -rawfile: path of the binary array (.raw). The sidecar has the same name with the .json extension.
+
+    """
+    file = Path(file)
+    rawfile = file.with_suffix('.raw')
+
+    with pd.HDFStore(file, mode='r') as store:
+        hours = list(hourKeys(store))
+        axes = [hourAxis(store, i) for i in hours]
+        bounds = np.cumsum([0] + [len(axis) for axis in axes])
+        labels = list(readHour(store, hours[0], 'both', start=0, stop=1).columns.drop('sec'))
+
+        array = np.memmap(rawfile, dtype=dtype, mode='w+', shape=(len(labels), bounds[-1]))
+        for k, i in enumerate(hours):
+            data = readHour(store, i, 'both').drop(columns=['sec'])
+            array[:, bounds[k]:bounds[k + 1]] = data.to_numpy(dtype=dtype).T
+        array.flush()
+        del array
+
+    sidecar = {'dtype': np.dtype(dtype).name,
+               'shape': [len(labels), int(bounds[-1])],
+               'labels': [str(label) for label in labels],
+               'fs': float(axes[0].fs),
+               'hours': [int(i) for i in hours],
+               'start_ns': [int(axis.start.value) for axis in axes],
+               'bounds': [int(b) for b in bounds]}
+    with open(rawfile.with_suffix('.json'), 'w') as f:
+        json.dump(sidecar, f, indent=2)
+
+    return rawfile
+
+class RawStore:
+    """
+    Raw channel store of a batch (see exportRawStore), opened as a read-only memory map: opening it is instant and
+    selecting a modality and/or a time range returns a view of the file, no samples are copied.
+
+    Attributes:
+    -------------------------------
+    -data: np.memmap (channels x samples) containing the raw data of the whole batch.
+    -labels: list containing the channel labels (EMG channels first).
+    -fs: sampling frequency (Hz).
+    -hours: list containing the hour indexes.
+    -axes: list containing the TimeAxis of each hour.
+    -bounds: array containing the first sample of each hour (and the total nb of samples as last element).
+
+    """
+    def __init__(self, rawfile):
+        rawfile = Path(rawfile)
+        with open(rawfile.with_suffix('.json')) as f:
+            sidecar = json.load(f)
+
+        self.labels = sidecar['labels']
+        self.fs = sidecar['fs']
+        self.hours = sidecar['hours']
+        self.bounds = np.array(sidecar['bounds'])
+        self.axes = [TimeAxis(pd.Timestamp(start), self.fs, self.bounds[k + 1] - self.bounds[k])
+                     for k, start in enumerate(sidecar['start_ns'])]
+        self.data = np.memmap(rawfile, dtype=sidecar['dtype'], mode='r', shape=tuple(sidecar['shape']))
+
+    def rows(self, startTime=None, endTime=None, step=1):
+        """
+        Slice of the samples (of the whole batch) within [startTime, endTime], found arithmetically on the axis of each
+        hour. With step > 1, the slice starts on a multiple of step (same samples as the downsampling of readHDF5).
+        """
+        first, last = None, None
+        for k, axis in enumerate(self.axes):
+            rows = axis.interval(startTime, endTime)
+            if rows.start < rows.stop:
+                first = self.bounds[k] + rows.start if first is None else first
+                last = self.bounds[k] + rows.stop
+        if first is None:
+            return slice(0, 0, step)
+        first += (-first) % step
+        return slice(int(first), int(max(first, last)), step)
+
+    def select(self, modality='both', startTime=None, endTime=None, step=1):
+        """
+        View (channels x samples) of the channels of a modality ('emg', 'acm' or 'both') within a time interval,
+        optionally downsampled by an integer step. No data is copied.
+        """
+        return self.data[MODALITY_CHANNELS[modality], self.rows(startTime, endTime, step)]
+
+    def timestamps(self, rows):
+        """
+        DatetimeIndex of the samples in rows (slice of the whole batch), generated only for those samples.
+        """
+        step = rows.step or 1
+        parts = []
+        for k, axis in enumerate(self.axes):
+            first = max(rows.start, self.bounds[k])
+            first += (rows.start - first) % step
+            last = min(rows.stop, self.bounds[k + 1])
+            if first < last:
+                parts.append(axis.timestamps(slice(first - self.bounds[k], last - self.bounds[k], step)))
+        return parts[0].append(parts[1:]) if parts else pd.DatetimeIndex([])
+
+    def frame(self, modality='both', startTime=None, endTime=None, step=1):
+        """
+        Same selection as select, as a dataframe (samples x channels) with the time-stamps as indexes.
+        """
+        channels = MODALITY_CHANNELS[modality]
+        rows = self.rows(startTime, endTime, step)
+        return pd.DataFrame(self.data[channels, rows].T, index=self.timestamps(rows), columns=self.labels[channels])
+
+class RecordingSession:
+    """
+    Lazy view of a full batch stored in an HDF5 file. Opening a session only reads the metadata of each hour (see
+    hourAxis), the data is loaded when it is indexed by hour, time range, channel or modality. The most recently
+    used hours are kept in an LRU cache; time ranges are read directly from the file (only their rows) unless
+    their hour is already cached. The data is downsampled as in readHDF5.
+
+    Usage:
+        with RecordingSession(patient, date, shift, batch, folder) as session:
+            session.duration                # no data loaded
+            session[3]                      # hour 3 (cached)
+            session['2024-01-01 23:00:00':'2024-01-01 23:01:00']   # one minute
+            session.select(startTime, endTime, modality='emg', channels=None)
+
+    Attributes:
+    -------------------------------
+    -file: path of the .h5 file.
+    -hours: list containing the hour indexes.
+    -axes: dict mapping each hour index to its TimeAxis (original sampling rate).
+    -channels: list containing the channel names (EMG channels first).
+    -rawFs: original sampling frequency (Hz).
+    -fs: sampling frequency after downsampling (Hz).
+    -samples: dict mapping each hour index to its nb of samples (original sampling rate).
+    -startTime: Timestamp, time-stamp of the first sample.
+    -endTime: Timestamp, time-stamp of the last sample.
+    -duration: duration of the batch (s).
+    -dtype: dtype of the returned channels (see SIGNAL_DTYPE).
+
+    """
+    def __init__(self, patient, date, shift, batch, folder, step=2, cache_size=2, dtype=SIGNAL_DTYPE):
+        # Check the location of the file to load
+        if folder == 'temp':
+            path = temp_path    
+        elif folder == 'perm':
+            path = perm_path
+
+        self.file = path / f"p{patient}" / f"p{patient}_{date}_{shift}_{batch}.h5"
+        self.step = step
+        self.cache_size = cache_size
+        self.dtype = dtype
+        self._cache = OrderedDict()
+
+        self._store = pd.HDFStore(self.file, mode='r')
+        self.axes = {i: hourAxis(self._store, i) for i in hourKeys(self._store)}
+        self.hours = list(self.axes)
+        self.channels = list(readHour(self._store, self.hours[0], 'both', start=0, stop=0).columns.drop('sec'))
+
+        self.rawFs = self.axes[self.hours[0]].fs
+        self.fs = self.rawFs / step
+        self.samples = {i: len(axis) for i, axis in self.axes.items()}
+        self.startTime = self.axes[self.hours[0]].start
+        self.endTime = self.axes[self.hours[-1]].end
+        self.duration = (self.endTime - self.startTime).total_seconds()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._cache.clear()
+        self._store.close()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.select(key.start, key.stop)
+        return self.hour(key)
+
+    def _columns(self, modality, channels):
+        if channels is None:
+            return self.channels[MODALITY_CHANNELS[modality]]
+        return [self.channels[c] if isinstance(c, (int, np.integer)) else c for c in channels]
+
+    def _block(self, i):
+        # Full hour at the original sampling rate, through the LRU cache
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+
+        block = readHour(self._store, i, 'both').drop(columns=['sec']).astype(self.dtype)
+        block.index = parseTimestamps(block.index)
+        self._cache[i] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return block
+
+    def hour(self, i, modality='both', channels=None):
+        """
+        Downsampled data of one hour (as readHDF5 with hrIdx=i), for a modality or a list of channels (names or indexes).
+        """
+        return self._block(i)[self._columns(modality, channels)].iloc[::self.step]
+
+    def select(self, startTime=None, endTime=None, modality='both', channels=None):
+        """
+        Downsampled data within [startTime, endTime] (as readHDF5 with hrIdx=0), for a modality or a list of channels
+        (names or indexes). Only the rows of the interval are read, from the cache when their hour is cached.
+        """
+        columns = self._columns(modality, channels)
+        parts = []
+        offset = 0
+        for i, axis in self.axes.items():
+            rows = axis.interval(startTime, endTime)
+            first = rows.start + (-(offset + rows.start)) % self.step
+            if first < rows.stop:
+                if i in self._cache:
+                    part = self._block(i).iloc[first:rows.stop:self.step]
+                else:
+                    part = readHour(self._store, i, modality if channels is None else 'both', start=first, stop=rows.stop)
+                    part = part.iloc[::self.step]
+                    part.index = parseTimestamps(part.index)
+                parts.append(part[columns].astype(self.dtype))
+            offset += len(axis)
+
+        if not parts:
+            return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([]))
+        return pd.concat(parts) if len(parts) > 1 else parts[0]
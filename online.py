@@ -0,0 +1,325 @@
+import json
+import time
+import socket
+import struct
+import pathlib
+import numpy as np
+import pandas as pd
+from timeit import default_timer as timer
+from load_data import loadHDF5, loadC3D, SIGNAL_DTYPE            # type: ignore
+from processing_tools import FilterPipeline                    # type: ignore
+from feature_extraction import extractFeatures                 # type: ignore
+import argparse
+
+# Header of each block sent over a socket (see serveFile): time-stamp of the first sample (int64 ns) and nb of samples (uint32)
+BLOCK_HEADER = struct.Struct('<qI')
+
+class RingBuffer:
+    """
+    Fixed-size buffer holding the last `capacity` samples of every channel. Each sample is written twice (at its
+    position and capacity rows further), so any range of up to capacity consecutive samples is a contiguous view,
+    whatever the write position: windows are read without copying or unwrapping.
+
+    Attributes:
+    -------------------------------
+    -capacity: int, nb of samples held.
+    -total: int, nb of samples appended so far (the global index of the next sample).
+
+    """
+    def __init__(self, capacity, channels, dtype=SIGNAL_DTYPE):
+        self.capacity = capacity
+        self.total = 0
+        self._values = np.zeros((2 * capacity, channels), dtype=dtype)
+        self._times = np.zeros(2 * capacity, dtype=np.int64)
+
+    def append(self, values, times):
+        """
+        Appends a block (samples x channels) and its time-stamps (int64 ns). The block must not exceed the capacity.
+        """
+        n = len(values)
+        if n > self.capacity:
+            raise ValueError(f"Block of {n} samples larger than the ring buffer ({self.capacity} samples)")
+        rows = np.arange(self.total, self.total + n) % self.capacity
+        for offset in (0, self.capacity):
+            self._values[rows + offset] = values
+            self._times[rows + offset] = times
+        self.total += n
+
+    def view(self, first, last):
+        """
+        Samples [first, last) (global indexes) and their time-stamps, as views into the buffer.
+        """
+        if first < self.total - self.capacity or last > self.total or last - first > self.capacity:
+            raise IndexError(f"Samples [{first}, {last}) are not in the ring buffer")
+        start = first % self.capacity
+        stop = start + (last - first)
+        return self._values[start:stop], self._times[start:stop]
+
+class OnlineDetector:
+    """
+    Online version of preprocess -> extractFeatures for bedside use: sample blocks are pushed as they arrive, filtered
+    with the pre-processing cascade carrying its state across blocks (see FilterPipeline.applyStateful), and stored
+    in a ring buffer. As soon as a sliding window is complete, its features are computed (only for the new windows)
+    and sent to the callback. The filtered samples and the features are the same as those of the offline pipeline
+    on the whole recording (bit for bit), whatever the block sizes.
+
+    Attributes:
+    -------------------------------
+    -fs: sampling frequency of the pushed samples (Hz).
+    -window_size, step: nb of samples in each window and between the starts of two consecutive windows.
+    -pipeline: FilterPipeline (highpass + notch, as in preprocess).
+    -buffer: RingBuffer holding the filtered samples.
+    -callback: function called with the features of each completed window (dict mapping each channel to a one-row
+               dataframe, as returned by extractFeatures), e.g. a threshold or a classifier. A truthy return value is
+               recorded as an alert.
+    -alerts: list of (start time of the window, value returned by the callback).
+    -latencies: list of the processing time (s) of every block, from its arrival to the return of the callback.
+
+    """
+    def __init__(self, columns, fs, hp_cutoff, notch_cutoffs, sliding_window, overlap, callback=None, capacity=None,
+                 dtype=SIGNAL_DTYPE, **kwargs):
+        self.columns = pd.Index(columns)
+        self.fs = fs
+        self.sliding_window, self.overlap = sliding_window, overlap
+        self.window_size = int(round(sliding_window * fs))
+        self.step = self.window_size - int(round(overlap * fs))
+        if self.step <= 0:
+            raise ValueError("The overlap must be shorter than the sliding window.")
+
+        # Running sums are centered on the mean of the whole signal (see runningFeatures) and the ACM gate needs the
+        # ACM channels: neither can reproduce the offline features window by window
+        if kwargs.get('incremental') or kwargs.get('acm') is not None:
+            raise ValueError("The online mode does not support the incremental and cascade (acm) options of extractFeatures")
+
+        self.pipeline = FilterPipeline(fs).highpass(hp_cutoff).notch(notch_cutoffs)
+        self.zi = None
+        self.dtype = dtype
+        # By default, room for one window and one second of samples
+        self.buffer = RingBuffer(capacity or self.window_size + int(fs), len(self.columns), dtype)
+        self.callback = callback
+        self.kwargs = kwargs
+        self.next_window = 0        # global index of the first sample of the next window
+        self.alerts = []
+        self.latencies = []
+
+    def push(self, block, times=None):
+        """
+        Processes a block of raw samples.
+
+        Args:
+        -----------------------------------------------------------------
+        -block: dataframe (samples x channels, with the time-stamps as indexes) or array containing the new samples.
+        -times: int64 ns time-stamps of the samples (only if block is an array). None to count the samples from 0, default: None
+
+        Returns:
+        -----------------------------------------------------------------
+        -features: features of the windows completed by the block (see extractFeatures), or None if no window was completed.
+
+        """
+        arrival = timer()
+        if isinstance(block, pd.DataFrame):
+            times = block.index.values.view(np.int64) if times is None else times
+            block = block.to_numpy()
+        if times is None:
+            times = ((self.buffer.total + np.arange(len(block))) * 1e9 / self.fs).astype(np.int64)
+
+        # Blocks larger than the free room of the ring buffer are processed in pieces
+        room = self.buffer.capacity - self.window_size
+        completed = []
+        for first in range(0, len(block), room):
+            filtered, self.zi = self.pipeline.applyStateful(block[first:(first + room)], self.zi, self.dtype)
+            self.buffer.append(filtered, times[first:(first + room)])
+            features = self._windows()
+            if features is not None:
+                completed.append(features)
+
+        features = None
+        if completed:
+            features = completed[0] if len(completed) == 1 else {name: pd.concat([f[name] for f in completed]) for name in completed[0]}
+            if self.callback is not None:
+                # One call per completed window (in order)
+                for k in range(len(next(iter(features.values())))):
+                    window = {name: values.iloc[k:(k + 1)] for name, values in features.items()}
+                    alert = self.callback(window)
+                    if alert:
+                        self.alerts.append((next(iter(window.values())).index[0], alert))
+
+        self.latencies.append(timer() - arrival)
+        return features
+
+    def _windows(self):
+        # Features of the windows completed so far and not computed yet
+        n_windows = (self.buffer.total - self.next_window - self.window_size) // self.step + 1
+        if n_windows <= 0:
+            return None
+        last = self.next_window + (n_windows - 1) * self.step + self.window_size
+        values, times = self.buffer.view(self.next_window, last)
+        data = pd.DataFrame(values, index=pd.DatetimeIndex(times.view('datetime64[ns]')), columns=self.columns)
+        self.next_window += n_windows * self.step
+        return extractFeatures(data, self.sliding_window, self.overlap, self.fs, **self.kwargs)
+
+    def latency(self, percentiles=(50, 90, 99, 100)):
+        """
+        Percentiles of the processing time of the blocks (ms).
+        """
+        if not self.latencies:
+            return {}
+        return dict(zip(percentiles, np.percentile(self.latencies, percentiles) * 1e3))
+
+def thresholdCallback(feature='RMS', threshold=100, min_channels=2):
+    """
+    Simple detector to use as callback of OnlineDetector: raises an alert when a feature of the window is at least
+    threshold in at least min_channels channels.
+
+    Returns:
+    -----------------------------------------------------------------
+    -callback: function returning the list of channels above threshold (alert) or None.
+
+    """
+    def callback(features):
+        channels = [channel for channel, values in features.items() if feature in values and values[feature].iloc[-1] >= threshold]
+        if len(channels) >= min_channels:
+            print(f"ALERT at {features[channels[0]].index[-1]}: {feature} >= {threshold} in {', '.join(map(str, channels))}")
+            return channels
+        return None
+    return callback
+
+def loadFile(file, modality='emg', step=2):
+    """
+    Loads a whole .c3d or .h5 file (see loadC3D and loadHDF5) to replay it.
+    """
+    file = pathlib.Path(file)
+    if file.suffix == '.c3d':
+        data, _, _ = loadC3D(file, modality, step=step)
+    else:
+        data, _ = loadHDF5(file, 0, modality, step=step)
+    return data
+
+def replayFile(file, modality='emg', block_size=100, step=2, fs=1000, realtime=False):
+    """
+    Replays a .c3d or .h5 file as a stream of blocks, as they would arrive from the acquisition system.
+
+    Args:
+    -----------------------------------------------------------------
+    -file: path of the .c3d or .h5 file.
+    -modality: either 'emg', 'acm' or 'both', default: 'emg'
+    -block_size: int, nb of samples in each block, default: 100
+    -step: int, downsampling step of the reader, default: 2
+    -fs: sampling frequency of the replayed (downsampled) data, only used to pace the blocks, default: 1000 Hz
+    -realtime: bool, whether to wait for each block as if it was being acquired, default: False
+
+    Yields
+    -----------------------------------------------------------------
+    -block: dataframe (block_size samples x channels) with the time-stamps as indexes.
+
+    """
+    data = loadFile(file, modality, step)
+    start = timer()
+    for first in range(0, len(data), block_size):
+        if realtime:
+            time.sleep(max(0, start + (first + block_size) / fs - timer()))
+        yield data.iloc[first:(first + block_size)]
+
+def serveFile(file, address=('127.0.0.1', 5555), modality='emg', block_size=100, step=2, fs=1000, realtime=True):
+    """
+    Stand-in for the acquisition system: serves a replayed file (see replayFile) to one client over a local TCP socket.
+    The stream starts with the channel names (uint32 length + JSON), then each block is sent as BLOCK_HEADER followed
+    by the samples (float32, samples x channels, little-endian).
+    """
+    with socket.create_server(address) as server:
+        connection, _ = server.accept()
+        with connection:
+            blocks = replayFile(file, modality, block_size, step, fs, realtime)
+            for k, block in enumerate(blocks):
+                if k == 0:
+                    header = json.dumps(list(map(str, block.columns))).encode()
+                    connection.sendall(struct.pack('<I', len(header)) + header)
+                values = block.to_numpy(dtype='<f4')
+                connection.sendall(BLOCK_HEADER.pack(block.index[0].value, len(values)) + values.tobytes())
+
+def socketSource(address=('127.0.0.1', 5555), fs=1000):
+    """
+    Receives the blocks served by serveFile (or by a bridge from the acquisition system using the same format).
+
+    Yields
+    -----------------------------------------------------------------
+    -block: dataframe (samples x channels) with the time-stamps (first sample + k / fs) as indexes.
+
+    """
+    with socket.create_connection(address) as connection:
+        stream = connection.makefile('rb')
+        size = stream.read(4)
+        if not size:
+            return
+        columns = json.loads(stream.read(struct.unpack('<I', size)[0]))
+        while True:
+            header = stream.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            start, nsamples = BLOCK_HEADER.unpack(header)
+            values = np.frombuffer(stream.read(4 * nsamples * len(columns)), dtype='<f4').reshape(nsamples, len(columns))
+            index = pd.DatetimeIndex((start + np.round(np.arange(nsamples) * 1e9 / fs).astype(np.int64)).view('datetime64[ns]'))
+            yield pd.DataFrame(values, index=index, columns=columns)
+
+def replay(file, hp_cutoff=20, notch_cutoffs=(58, 62), sliding_window=2, overlap=1, fs=1000, modality='emg', block_size=100,
+           step=2, callback=None, realtime=False, compare=True, **kwargs):
+    """
+    Runs the online mode on a replayed file, reports the latency percentiles and compares the features with those of
+    the offline pipeline (preprocess -> extractFeatures on the whole file), which should be identical.
+
+    Args:
+    -----------------------------------------------------------------
+    -file: path of the .c3d or .h5 file.
+    -hp_cutoff, notch_cutoffs: pre-processing parameters (see preprocess).
+    -sliding_window, overlap: duration (s) of each window and of the overlap between two consecutive windows.
+    -fs: sampling frequency of the replayed (downsampled) data, default: 1000 Hz
+    -modality, block_size, step, realtime: see replayFile.
+    -callback: detector called with the features of the completed windows (see OnlineDetector), default: None
+    -compare: bool, whether to run the offline pipeline and compare the features, default: True
+    -kwargs: other arguments passed to extractFeatures (e.g. pairs, nperseg).
+
+    Returns:
+    -----------------------------------------------------------------
+    -detector: OnlineDetector after the replay.
+    -features: dict mapping each channel name to a dataframe (windows x features) of all the windows.
+
+    """
+    detector = None
+    chunks = []
+    for block in replayFile(file, modality, block_size, step, fs, realtime):
+        if detector is None:
+            detector = OnlineDetector(block.columns, fs, hp_cutoff, notch_cutoffs, sliding_window, overlap, callback, **kwargs)
+        features = detector.push(block)
+        if features is not None:
+            chunks.append(features)
+    features = {name: pd.concat([chunk[name] for chunk in chunks]) for name in chunks[0]} if chunks else {}
+
+    latency = detector.latency()
+    print(f"{len(detector.latencies)} blocks of {block_size} samples ({1e3 * block_size / fs:.0f} ms), latency "
+          + ", ".join(f"p{p}: {value:.2f} ms" for p, value in latency.items()) + f", {len(detector.alerts)} alerts")
+
+    if compare:
+        from processing_tools import preprocess     # type: ignore
+        offline = extractFeatures(preprocess(loadFile(file, modality, step), hp_cutoff, notch_cutoffs, fs), sliding_window, overlap, fs, **kwargs)
+        error = max(np.nanmax(np.abs(features[name].to_numpy() - offline[name].to_numpy()), initial=0) for name in offline)
+        same = all(features[name].equals(offline[name]) for name in offline)
+        print(f"Online vs offline features: {'identical' if same else f'max difference {error:.3e}'}")
+
+    return detector, features
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Replay a recording through the online detection mode")
+    parser.add_argument('file', type=str, help="Path of the .c3d or .h5 file to replay")
+    parser.add_argument('--modality', type=str, default='emg', help="emg, acm or both")
+    parser.add_argument('--fs', type=float, default=1000, help="Sampling frequency of the replayed (downsampled) data (Hz)")
+    parser.add_argument('--block', type=int, default=100, help="Nb of samples in each block")
+    parser.add_argument('--window', type=float, default=2, help="Duration of each window (s)")
+    parser.add_argument('--overlap', type=float, default=1, help="Overlap between two consecutive windows (s)")
+    parser.add_argument('--feature', type=str, default='RMS', help="Feature used by the threshold detector")
+    parser.add_argument('--threshold', type=float, default=100, help="Threshold of the detector")
+    parser.add_argument('--realtime', action='store_true', help="Pace the blocks as if they were being acquired")
+
+    args = parser.parse_args()
+
+    replay(args.file, sliding_window=args.window, overlap=args.overlap, fs=args.fs, modality=args.modality, block_size=args.block,
+           callback=thresholdCallback(args.feature, args.threshold), realtime=args.realtime)
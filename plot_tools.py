@@ -1,9 +1,34 @@
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-from scipy.fftpack import fft
 import numpy as np
+from scipy.signal import get_window
+from feature_extraction import Spectrum, slidingWindows
 
-def plotEMG(data, muscles='all', y_axis_max=3500, colors=True, title='EMG'):
+def envelope(values, first, last, bins):
+    """
+    Min/max envelope of rows [first, last) of a signal, reduced to a fixed nb of bins (e.g. one per pixel column) with
+    one vectorized reduction per channel. Drawn as a line alternating between the min and the max of each bin, it
+    looks the same as the full signal at that resolution.
+
+    Args:
+    -----------------------------------------------------------------
+    -values: array (samples x channels) containing the signal.
+    -first, last: int, rows of the range to reduce.
+    -bins: int, nb of bins.
+
+    Returns:
+    -----------------------------------------------------------------
+    -rows: array of shape (2 * bins,) containing the first row of each bin, twice.
+    -y: array of shape (2 * bins x channels) alternating the min and the max of each bin.
+
+    """
+    edges = np.unique(np.linspace(first, last, bins + 1).astype(np.int64)[:-1])
+    lo = np.minimum.reduceat(values[first:last], edges - first, axis=0)
+    hi = np.maximum.reduceat(values[first:last], edges - first, axis=0)
+    y = np.stack([lo, hi], axis=1).reshape(2 * len(edges), values.shape[1])
+    return np.repeat(edges, 2), y
+
+def plotEMG(data, muscles='all', y_axis_max=3500, colors=True, title='EMG', lod=True):
     """
     Plots the specified EMG channels
 
@@ -14,6 +39,9 @@ def plotEMG(data, muscles='all', y_axis_max=3500, colors=True, title='EMG'):
     -y_axis_max: int, y-axis limit as absolute value, default=3500 (uV)
     -colors: bool, whether to plot channels with the same color scheme used in Cometa, default=True
     -title: str, title of the plot and .png figure, default='EMG'
+    -lod: bool, level-of-detail rendering: each channel is drawn as its min/max envelope over one bin per pixel column (see envelope),
+          so the drawing cost depends on the width of the figure, not on the length of the recording. Zooming re-bins only
+          the visible range. Only used when there are more samples than pixel columns, default=True
 
     Returns:
     -----------------------------------------------------------------
@@ -32,83 +60,158 @@ def plotEMG(data, muscles='all', y_axis_max=3500, colors=True, title='EMG'):
     else:
         colors2plot = ['tab:blue'] * len(data.columns)
 
-    # Get column names of muscles to drop
-    cols2drop = data.columns[musc2drop]
-
-    # Drop those channels
-    data = data.drop(columns=cols2drop)
+    # Get the columns of the muscles to plot (no copy of the data)
+    cols2plot = [index for index in range(len(data.columns)) if index not in musc2drop]
+    names = data.columns[cols2plot]
+    values = data.to_numpy()
+    times = data.index.values
 
     y_axis_min = -1 * y_axis_max
     
-    fig, axes = plt.subplots(len(data.columns), sharex=True, figsize=(15, len(data.columns)))
+    fig, axes = plt.subplots(len(names), sharex=True, figsize=(15, len(names)))
 
-    if len(data.columns) == 1:
+    if len(names) == 1:
         axes = [axes]
 
+    # One bin per pixel column of the figure
+    bins = int(fig.get_figwidth() * fig.dpi)
+    lod = lod and len(data) > 2 * bins
+    if lod:
+        rows, y = envelope(values, 0, len(data), bins)
+        y = y[:, cols2plot]
+
+    lines = []
     for i, ax in enumerate(axes):
-        ax.plot(data.index, data.iloc[:, i], colors2plot[i])
-        ax.set_ylabel(data.columns[i], rotation=0, labelpad=50)
+        if lod:
+            lines += ax.plot(times[rows], y[:, i], colors2plot[i])
+        else:
+            ax.plot(data.index, values[:, cols2plot[i]], colors2plot[i])
+        ax.set_ylabel(names[i], rotation=0, labelpad=50)
         ax.set_ylim([y_axis_min, y_axis_max])
         ax.set_xlim([data.index[0], data.index[-1]])
 
         if i == 0:
             ax.set_title(title, fontsize=14)
 
-        if i == len(data.columns) - 1:
+        if i == len(names) - 1:
             ax.set_xlabel("Time")
             ax.xaxis.set_major_locator(mdates.AutoDateLocator(interval_multiples=True))
             ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
         else:
             ax.set_xticks([])
 
+    if lod:
+        def rebin(ax):
+            # Re-bin only the visible range (the axes share x, so one callback updates every channel)
+            start, end = mdates.num2date(ax.get_xlim())
+            first = max(np.searchsorted(times, np.datetime64(start.replace(tzinfo=None)), 'left') - 1, 0)
+            last = min(np.searchsorted(times, np.datetime64(end.replace(tzinfo=None)), 'right') + 1, len(times))
+            if last - first < 2:
+                return
+            if last - first > 2 * bins:
+                rows, y = envelope(values, first, last, bins)
+                x, y = times[rows], y[:, cols2plot]
+            else:
+                x, y = times[first:last], values[first:last][:, cols2plot]
+            for i, line in enumerate(lines):
+                line.set_data(x, y[:, i])
+
+        axes[0].callbacks.connect('xlim_changed', rebin)
+
     date_rec_started = data.index[0].strftime('%d-%b-%Y')
     date_rec_ended = data.index[-1].strftime('%d-%b-%Y')
     fig.text(0.01, 0.01, f'{date_rec_started}', horizontalalignment='left')
     fig.text(0.99, 0.01, f'{date_rec_ended}', horizontalalignment='right')
 
     plt.tight_layout()
-    plt.show()
     plt.savefig(f"{title}.png")
+    plt.show()
 
     return None
 
-def plotFreq(signal, channel_name, save_name, fs=1000):
+def welchSpectrum(signal, fs=1000, nperseg=1024, block_size=1024):
+    """
+    Power spectral density of a long signal estimated with Welch's method (Hann window, 50% overlap, same scaling as
+    scipy.signal.welch), computed in blocks of segments: the segments are strided views (see slidingWindows) and at most
+    block_size of them are transformed at once, so the memory used does not depend on the length of the signal.
+
+    Args:
+    -----------------------------------------------------------------
+    -signal: array containing the data of a single channel.
+    -fs: sampling frequency of the signal, default: 1000 Hz
+    -nperseg: int, nb of samples in each segment (at most the length of the signal, as in scipy.signal.welch), default: 1024
+    -block_size: int, nb of segments transformed at once, default: 1024
+
+    Returns:
+    -----------------------------------------------------------------
+    -freqs: array containing the frequency axis (Hz).
+    -psd: array containing the power spectral density.
+
+    """
+    if len(signal) == 0:
+        raise ValueError("Cannot estimate the spectrum of an empty signal")
+    nperseg = min(nperseg, len(signal))
+    segments = slidingWindows(signal, nperseg, max(1, nperseg // 2))
+    hann = get_window('hann', nperseg).astype(segments.dtype)[:, np.newaxis]
+
+    total = 0
+    for first in range(0, len(segments), block_size):
+        block = segments[first : (first + block_size)]
+        # Remove the mean of each segment (detrend='constant'), then apply the window
+        block = (block - block.mean(axis=1, keepdims=True)) * hann
+        spectrum = Spectrum(block, fs)
+        total = total + spectrum.psd.sum(axis=0)[:, 0]
+
+    psd = total / len(segments) / (fs * np.sum(np.square(hann)))
+    psd[1:(-1 if nperseg % 2 == 0 else None)] *= 2
+    return spectrum.freqs, psd
+
+def plotFreq(signal, channel_name, save_name, fs=1000, spectrum=None, window=0, channel=0, nperseg=None):
     """
     Plots the frequency spectrum of a single EMG channel
 
     Args:
     -----------------------------------------------------------------
-    -signal: array containing the emg data of a single EMG channel
+    -signal: array containing the emg data of a single EMG channel. Ignored if spectrum is given.
     -channel_name: str, name of the channel that will be displayed in the title of the figure
     -save_name: str, file name to save the figure as (.png)
     -fs: sampling frequency of the signal, default: 1000 Hz
+    -spectrum: Spectrum already computed by feature_extraction, to plot one of its windows without running another FFT, default: None
+    -window: int, index of the window to plot when spectrum is given, default: 0
+    -channel: int, index of the channel to plot when spectrum is given, default: 0
+    -nperseg: int, nb of samples per segment to plot the chunked Welch spectrum of the signal (see welchSpectrum) instead of a single FFT
+              of the whole signal. Recommended for long signals (e.g. hours), default: None
 
     Returns:
     -----------------------------------------------------------------
     None
 
     """
-    # Compute period
-    T = 1/fs
+    if nperseg is not None and spectrum is None:
+        # Chunked Welch spectrum (averaged over segments)
+        freq_axis, y = welchSpectrum(np.asarray(signal), fs, nperseg)
+        ylabel = 'PSD'
+    else:
+        # Apply Fast Fourier Transform (single window, single channel)
+        if spectrum is None:
+            signal = np.asarray(signal)
+            spectrum = Spectrum(signal.reshape(1, len(signal), 1), fs)
+            window, channel = 0, 0
 
-    # Compute frequency axis
-    nsig = len(signal)
-    freqs = np.fft.fftfreq(nsig, T)
-    freq_axis = freqs[:nsig // 2]
-    
-    # Apply Fast Fourier Transform
-    signalFFT = fft(signal)
-    y = (np.abs(signalFFT)[:nsig // 2]) / nsig
+        # Frequency axis and magnitude (averaged over segments)
+        freq_axis = spectrum.freqs
+        y = np.mean(np.abs(spectrum.fft[window, :, :, channel]), axis=0) / spectrum.nperseg
+        ylabel = 'Magnitude'
 
     # Plot frequency spectrum
     plt.figure(figsize=(12, 6))
     plt.plot(freq_axis, y)
     plt.xlabel('Frequency (Hz)')
-    plt.ylabel('Magnitude')
+    plt.ylabel(ylabel)
     plt.title(f"Frequency Spectrum of {channel_name}")
     plt.grid()
     plt.tight_layout()
-    plt.show()
     plt.savefig(f"{save_name}.png")
+    plt.show()
 
     return None
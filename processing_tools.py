@@ -1,24 +1,304 @@
-from scipy.signal import butter, sosfilt
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.signal import butter, sosfilt, resample_poly
+from instrumentation import stage, message   # type: ignore
 
-def timerange(data, startTime, endTime):
+# Filter designs already computed, keyed by (type, cutoffs, order, fs)
+_designs = {}
+
+def timerange(data, startTime, endTime, axis=None):
     """
     Extracts a subset of the dataframe containing rows within a specified time interval.
 
     Args:
     -----------------------------------------------------------------
-    -data: dataframe from which the specified time interval will be extracted. 
+    -data: dataframe from which the specified time interval will be extracted. Can also be an array (samples x channels) if axis is given.
     -startTime: str, start timestamp of the time interval in the format 'yyyy-mm-dd HH:MM:SS'.
     -endTime: str, end timestamp of the time interval in the format 'yyyy-mm-dd HH:MM:SS'.
+    -axis: TimeAxis of the data. If given, the rows are found arithmetically (no per-sample DatetimeIndex is needed) and 
+           the time-stamps are only generated for the returned rows, default: None
 
     Returns:
     -----------------------------------------------------------------
     -datarange: new dataframe containing only the rows within the specified time interval.
 
     """
-    datarange = data[startTime : endTime]
+    if axis is None:
+        datarange = data[startTime : endTime]
+        return datarange
+
+    rows = axis.interval(startTime, endTime)
+    if isinstance(data, pd.DataFrame):
+        datarange = data.iloc[rows]
+    else:
+        datarange = pd.DataFrame(np.asarray(data)[rows], index=axis.timestamps(rows))
     return datarange
 
-def lowpass(data, cutoff):
+def filterDesign(btype, cutoffs, order=2, fs=1000):
+    """
+    Designs a digital butterworth filter (second-order sections). Designs are cached, so each
+    (type, cutoffs, order, fs) combination is only computed once.
+
+    Args:
+    -----------------------------------------------------------------
+    -btype: str, either 'lowpass', 'highpass', 'bandpass' or 'bandstop'.
+    -cutoffs: int or length-2 sequence, cutoff frequencies (Hz) at which the gain drops -3dB.
+    -order: int, order of the filter, default: 2
+    -fs: sampling frequency of the signal, default: 1000 Hz
+
+    Returns:
+    -----------------------------------------------------------------
+    -sos: array containing the second-order sections of the filter. Must not be modified.
+
+    """
+    cutoffs = tuple(float(c) for c in np.atleast_1d(cutoffs))
+    key = (btype, cutoffs, int(order), float(fs))
+    if key not in _designs:
+        _designs[key] = butter(order, cutoffs if len(cutoffs) > 1 else cutoffs[0], btype, fs=fs, output='sos')
+    return _designs[key]
+
+class FilterPipeline:
+    """
+    Cascade of butterworth filters applied in a single pass. Each stage is designed once (see filterDesign)
+    and all stages are stacked into one array of second-order sections, so the data is filtered by a single
+    sosfilt call along the time axis, without intermediate copies. The cascade can be preceded by an anti-aliased
+    decimation stage (see decimate), in which case all the filter stages run at the lower rate.
+
+    The output keeps the dtype of the input (or the requested dtype), so float32 signals are never upcast to
+    float64 arrays. For lower-precision dtypes, the coefficients and filter states stay in float64 and the signal
+    is filtered channel by channel, so only one channel at a time is held in float64.
+
+    Attributes:
+    -----------------------------------------------------------------
+    -fs: sampling frequency at which the filter stages run (e.g. the fs of OriginalRecordingInfo, divided by the downsampling factor).
+    -rawFs: sampling frequency of the input signal (differs from fs only if the pipeline decimates).
+    -factor: int, decimation factor (1 if the pipeline does not decimate).
+    -decimation: decimation method, either 'fir', 'iir' or 'slice' (None if the pipeline does not decimate).
+    -stages: list of (type, cutoffs, order) tuples, in the order in which they are applied.
+    -sos: array containing the second-order sections of the whole cascade.
+
+    """
+    def __init__(self, fs=1000):
+        self.fs = fs
+        self.rawFs = fs
+        self.factor = 1
+        self.decimation = None
+        self.stages = []
+        self.sos = np.empty((0, 6))
+
+    def decimate(self, factor, method='fir'):
+        """
+        Adds a decimation stage, which must come before the filter stages: the signal is downsampled by an integer
+        factor and the filter stages added afterwards are designed and applied at fs / factor. Returns the pipeline.
+
+        Methods:
+        -'fir': polyphase FIR anti-alias filter (scipy's resample_poly), only the kept samples are computed and the
+                delay of the filter is compensated, so sample k of the output is aligned with sample k * factor of the input.
+        -'iir': 8th order butterworth lowpass at 80% of the new Nyquist frequency, then every factor-th sample is kept (causal, like the filter stages).
+        -'slice': every factor-th sample is kept without anti-alias filter (data[::factor], as readHDF5/readC3D do), for comparison.
+        """
+        if self.stages or self.factor != 1:
+            raise ValueError("The decimation stage must be added once, before the filter stages")
+        if method not in ('fir', 'iir', 'slice'):
+            raise ValueError(f"Unknown decimation method '{method}', expected 'fir', 'iir' or 'slice'")
+        self.factor = int(factor)
+        self.decimation = method
+        self.fs = self.rawFs / self.factor
+        return self
+
+    def _decimate(self, values, dtype):
+        # Decimation stage (see decimate), returns a new array of the given dtype
+        if self.decimation == 'fir':
+            return resample_poly(values.astype(dtype, copy=False), 1, self.factor, axis=0)
+        if self.decimation == 'iir':
+            antialias = filterDesign('lowpass', 0.4 * self.fs, order=8, fs=self.rawFs)
+            decimated = np.empty((-(-len(values) // self.factor),) + values.shape[1:], dtype=dtype)
+            return _filterChannels(antialias, values, decimated, step=self.factor)
+        return values[::self.factor].astype(dtype)
+
+    def add(self, btype, cutoffs, order=2):
+        """
+        Appends a stage to the cascade and returns the pipeline (so that calls can be chained).
+        """
+        self.stages.append((btype, cutoffs, order))
+        self.sos = np.vstack([self.sos, filterDesign(btype, cutoffs, order, self.fs)])
+        return self
+
+    def lowpass(self, cutoff, order=2):
+        return self.add('lowpass', cutoff, order)
+
+    def highpass(self, cutoff, order=2):
+        return self.add('highpass', cutoff, order)
+
+    def bandpass(self, cutoffs, order=2):
+        return self.add('bandpass', cutoffs, order)
+
+    def notch(self, cutoffs, order=2):
+        return self.add('bandstop', cutoffs, order)
+
+    def apply(self, data, inplace=False, dtype=None):
+        """
+        Filters every channel of the data with the whole cascade in a single pass (after the decimation stage, if any).
+
+        Args:
+        -----------------------------------------------------------------
+        -data: dataframe or array (samples x channels) containing the data to be filtered.
+        -inplace: bool, whether to overwrite the input array (channel by channel, so no full-size intermediate array is created). Only for arrays with the requested dtype and pipelines that do not decimate, default: False
+        -dtype: dtype of the filtered data (e.g. np.float32), default: dtype of the input data (float64 for integer data)
+
+        Returns:
+        -----------------------------------------------------------------
+        -data_filtered: dataframe or array (same type as the input) containing the filtered (and decimated) data.
+
+        """
+        if isinstance(data, pd.DataFrame):
+            filtered = self.apply(data.to_numpy(), dtype=dtype)
+            return pd.DataFrame(filtered, index=data.index[::self.factor], columns=data.columns)
+
+        values = np.asarray(data)
+        if dtype is None:
+            dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+
+        if self.factor > 1:
+            # The decimated array is new, filter it in place
+            values = self._decimate(values, dtype)
+            return _filterChannels(self.sos, values, values) if len(self.sos) else values
+
+        if inplace and values.dtype == dtype:
+            return _filterChannels(self.sos, values, values)
+        if np.dtype(dtype) == np.float64:
+            return sosfilt(self.sos, values.astype(dtype, copy=False), axis=0)
+        return _filterChannels(self.sos, values, np.empty(values.shape, dtype=dtype))
+
+    def applyStateful(self, data, zi=None, dtype=None):
+        """
+        Filters a chunk of a longer signal, starting from the filter state left by the previous chunk. Filtering
+        consecutive chunks this way gives the same output as filtering the whole signal at once.
+
+        Args:
+        -----------------------------------------------------------------
+        -data: dataframe or array (samples x channels) containing the chunk to be filtered.
+        -zi: array of shape (sections x 2 x channels) containing the state (float64) returned for the previous chunk. None for the first chunk, default: None
+        -dtype: dtype of the filtered data (e.g. np.float32), default: dtype of the input data (float64 for integer data)
+
+        Returns:
+        -----------------------------------------------------------------
+        -data_filtered: dataframe or array (same type as the input) containing the filtered chunk.
+        -zf: array containing the filter state to pass to the next chunk.
+
+        """
+        if self.factor > 1:
+            raise ValueError("applyStateful does not support decimation, decimate the chunks beforehand")
+        if isinstance(data, pd.DataFrame):
+            filtered, zf = self.applyStateful(data.to_numpy(), zi, dtype)
+            return pd.DataFrame(filtered, index=data.index, columns=data.columns), zf
+
+        values = np.asarray(data)
+        if dtype is None:
+            dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+        if zi is None:
+            zi = np.zeros((self.sos.shape[0], 2) + values.shape[1:])
+
+        filtered, zf = sosfilt(self.sos, values, axis=0, zi=zi)
+        return filtered.astype(dtype, copy=False), zf
+
+    def transition(self, nsamples):
+        """
+        State-transition matrix of the cascade over nsamples samples of zero input, i.e. the matrix M such that
+        filtering nsamples zeros from the (flattened) initial state zi ends in the state M @ zi.
+        """
+        nstates = self.sos.shape[0] * 2
+        basis = np.eye(nstates).reshape(self.sos.shape[0], 2, nstates)
+        _, zf = sosfilt(self.sos, np.zeros((1, nstates)), axis=0, zi=basis)
+        step = zf.reshape(nstates, nstates)
+        return np.linalg.matrix_power(step, nsamples)
+
+    def applyParallel(self, data, workers=None, segment_size=None, executor='thread', dtype=None):
+        """
+        Filters every channel of the data with the whole cascade, splitting the signal into time segments and
+        channels that are filtered on a pool of workers. The filter state is handed off across segment boundaries,
+        so the output matches a single sequential pass (apply) within float tolerance. The decimation stage (if any)
+        is applied first, in a single pass, so the segments are filtered at the lower rate:
+            1. Each segment is filtered from a zero state, in parallel, to get its final state.
+            2. The true initial state of each segment is propagated sequentially with the state-transition matrix (cheap).
+            3. Each segment is filtered again from its true initial state, in parallel.
+
+        Args:
+        -----------------------------------------------------------------
+        -data: dataframe or array (samples x channels) containing the data to be filtered.
+        -workers: int, nb of workers in the pool, default: nb of CPUs
+        -segment_size: int, nb of samples in each time segment, default: nb of samples / workers
+        -executor: either 'thread' (shared memory, sosfilt releases the GIL) or 'process', default: 'thread'
+        -dtype: dtype of the filtered data (e.g. np.float32), default: dtype of the input data (float64 for integer data)
+
+        Returns:
+        -----------------------------------------------------------------
+        -data_filtered: dataframe or array (same type as the input) containing the filtered data.
+
+        """
+        if isinstance(data, pd.DataFrame):
+            filtered = self.applyParallel(data.to_numpy(), workers, segment_size, executor, dtype)
+            return pd.DataFrame(filtered, index=data.index[::self.factor], columns=data.columns)
+
+        values = np.asarray(data)
+        if dtype is None:
+            dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+        if self.factor > 1:
+            values = self._decimate(values, dtype)
+        squeeze = values.ndim == 1
+        if squeeze:
+            values = values[:, np.newaxis]
+
+        workers = workers or os.cpu_count()
+        nsamples, nchannels = values.shape
+        if segment_size is None:
+            segment_size = max(1, -(-nsamples // workers))
+        bounds = [(start, min(start + segment_size, nsamples)) for start in range(0, nsamples, segment_size)]
+
+        sos = self.sos
+        nsections = sos.shape[0]
+        pool_type = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+        with pool_type(max_workers=workers) as pool:
+            # 1. Final state of each segment (except the last one) filtered from a zero state
+            jobs = [pool.submit(_finalState, sos, values[start:end, c])
+                    for start, end in bounds[:-1] for c in range(nchannels)]
+            final = np.array([job.result() for job in jobs]).reshape(len(bounds) - 1, nchannels, nsections * 2)
+
+            # 2. Hand off the state across segment boundaries
+            M = self.transition(segment_size)
+            initial = np.zeros((len(bounds), nchannels, nsections * 2))
+            for k in range(1, len(bounds)):
+                initial[k] = final[k - 1] + initial[k - 1] @ M.T
+
+            # 3. Filter each segment from its true initial state
+            filtered = np.empty((nsamples, nchannels), dtype=dtype)
+            jobs = {pool.submit(_filterSegment, sos, values[start:end, c], initial[k, c].reshape(nsections, 2)): (start, end, c)
+                    for k, (start, end) in enumerate(bounds) for c in range(nchannels)}
+            for job, (start, end, c) in jobs.items():
+                filtered[start:end, c] = job.result()
+
+        return filtered[:, 0] if squeeze else filtered
+
+def _filterChannels(sos, values, out, step=1):
+    # Filters each channel with float64 coefficients and state, writing every step-th sample into out (which may be values)
+    if values.ndim == 1:
+        out[:] = sosfilt(sos, values)[::step]
+    else:
+        for c in range(values.shape[1]):
+            out[:, c] = sosfilt(sos, values[:, c])[::step]
+    return out
+
+def _finalState(sos, segment):
+    _, zf = sosfilt(sos, segment, zi=np.zeros((sos.shape[0], 2)))
+    return zf.ravel()
+
+def _filterSegment(sos, segment, zi):
+    filtered, _ = sosfilt(sos, segment, zi=zi)
+    return filtered
+
+def lowpass(data, cutoff, fs=1000):
     """
     Designs and applies a digital 2nd order lowpass butterworth filter.
 
@@ -26,17 +306,18 @@ def lowpass(data, cutoff):
     -----------------------------------------------------------------
     -data: dataframe containing the data to be filtered.
     -cutoff: int, cutoff frequency (Hz) at which the gain drops -3dB.
+    -fs: sampling frequency of the signal, default: 1000 Hz
 
     Returns:
     -----------------------------------------------------------------
     -data_lp: dataframe containing the filtered data. 
 
     """
-    lpass_design = butter(2, cutoff, 'lowpass', fs=1000, output='sos')
+    lpass_design = filterDesign('lowpass', cutoff, fs=fs)
     data_lp = sosfilt(lpass_design, data)
     return data_lp
 
-def highpass(data, cutoff):
+def highpass(data, cutoff, fs=1000):
     """
     Designs and applies a digital 2nd order highpass butterworth filter.
 
@@ -44,17 +325,18 @@ def highpass(data, cutoff):
     -----------------------------------------------------------------
     -data: dataframe containing the data to be filtered.
     -cutoff: int, cutoff frequency (Hz) at which the gain drops -3dB.
+    -fs: sampling frequency of the signal, default: 1000 Hz
 
     Returns:
     -----------------------------------------------------------------
     -data_hp: dataframe containing the filtered data. 
 
     """
-    hpass_design = butter(2, cutoff, 'highpass', fs=1000, output='sos')
+    hpass_design = filterDesign('highpass', cutoff, fs=fs)
     data_hp = sosfilt(hpass_design, data)
     return data_hp
 
-def bandpass(data, cutoffs):
+def bandpass(data, cutoffs, fs=1000):
     """
     Designs and applies a digital 2nd order bandpass butterworth filter.
 
@@ -62,17 +344,18 @@ def bandpass(data, cutoffs):
     -----------------------------------------------------------------
     -data: dataframe containing the data to be filtered.
     -cutoffs: length-2 sequence, cutoff frequencies (Hz) at which the gain drops -3dB.
+    -fs: sampling frequency of the signal, default: 1000 Hz
 
     Returns:
     -----------------------------------------------------------------
     -data_bp: dataframe containing the filtered data. 
 
     """
-    bpass_design = butter(2, cutoffs, 'bandpass', fs=1000, output='sos')
+    bpass_design = filterDesign('bandpass', cutoffs, fs=fs)
     data_bp = sosfilt(bpass_design, data)
     return data_bp
 
-def notch(data, cutoffs):
+def notch(data, cutoffs, fs=1000):
     """
     Designs and applies a digital 2nd order bandstop (notch) butterworth filter.
 
@@ -80,38 +363,55 @@ def notch(data, cutoffs):
     -----------------------------------------------------------------
     -data: dataframe containing the data to be filtered.
     -cutoffs: length-2 sequence, cutoff frequencies (Hz) at which the gain drops -3dB.
+    -fs: sampling frequency of the signal, default: 1000 Hz
 
     Returns:
     -----------------------------------------------------------------
     -data_notch: dataframe containing the filtered data. 
 
     """
-    notch_design = butter(2, cutoffs, 'bandstop', fs=1000, output='sos')
+    notch_design = filterDesign('bandstop', cutoffs, fs=fs)
     data_notch = sosfilt(notch_design, data)
     return data_notch
 
-def preprocess(data, hp_cutoff, notch_cutoffs):
+def preprocess(data, hp_cutoff, notch_cutoffs, fs=1000, inplace=False, dtype=None, workers=None, factor=1, decimation='fir'):
     """
     Applies the established pre-processing pipeline: 
+        0. Anti-aliased decimation (optional, only if factor > 1)
         1. Highpass filter
         2. Notch filter
+    Both filters are stacked into a single cascade (see FilterPipeline) and applied in one pass. When decimating,
+    the data should be loaded at full rate (readHDF5/readC3D with step=1): it is downsampled once with an anti-alias
+    filter and both filters run at the lower rate fs / factor.
 
     Args:
     -----------------------------------------------------------------
     -data: dataframe containing the data to be filtered.
     -hp_cutoff: int, cutoff frequency (Hz) for the highpass filter.
     -notch_cutoffs: length-2 sequence, cutoff frequencies (Hz) for bandstop filter.
+    -fs: sampling frequency of the data, default: 1000 Hz
+    -inplace: bool, whether to overwrite the input array (arrays only, see FilterPipeline.apply), default: False
+    -dtype: dtype of the filtered data (e.g. np.float32), default: dtype of the input data
+    -workers: int, nb of workers to filter time segments and channels in parallel (see FilterPipeline.applyParallel). None for a single sequential pass, default: None
+    -factor: int, decimation factor applied before filtering. 1 to keep the sampling frequency, default: 1
+    -decimation: decimation method, either 'fir' (polyphase anti-alias), 'iir' or 'slice' (data[::factor], no anti-alias), see FilterPipeline.decimate, default: 'fir'
 
     Returns:
     -----------------------------------------------------------------
-    -data_filtered: dataframe containing the filtered data. 
+    -data_filtered: dataframe containing the filtered data, at fs / factor.
 
     """ 
-    # High-pass filter
-    print("FILTERING - HIGHPASS")
-    data_hp = data.apply(lambda x: highpass(x, hp_cutoff), axis=0)
-
-    # Notch filter
-    print("FILTERING - BANDSTOP")
-    data_filtered = data_hp.apply(lambda x: notch(x, notch_cutoffs), axis=0)
+    with stage('preprocess') as s:
+        pipeline = FilterPipeline(fs)
+        if factor > 1:
+            message(f"FILTERING - DECIMATION (x{factor}) + HIGHPASS + BANDSTOP")
+            pipeline.decimate(factor, decimation)
+        else:
+            message("FILTERING - HIGHPASS + BANDSTOP")
+        pipeline.highpass(hp_cutoff).notch(notch_cutoffs)
+        if workers is None:
+            data_filtered = pipeline.apply(data, inplace=inplace, dtype=dtype)
+        else:
+            data_filtered = pipeline.applyParallel(data, workers=workers, dtype=dtype)
+        s.count(data)
     return data_filtered
@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import fcntl
+import socket
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+from config import temp_path, perm_path # type: ignore
+from TSGv4 import convert_hours, write_hour # type: ignore
+from load_data import hourKeys             # type: ignore
+import argparse
+
+# Manifest recording the hours already converted for every batch
+manifest_file = temp_path / 'manifest.json'
+
+# Name of an hour-long C3D file, p{patient}_{date}_{shift}_{batch}_{hour}.c3d
+c3d_pattern = re.compile(r'p(\w+?)_(\d{8})_([DAN])_(\d+)_(\d+)\.c3d$')
+
+def find_batches(folders=('temp', 'perm')):
+    """
+    Finds every batch of C3D files under the temporary and/or permanent folders.
+
+    Args
+    -------------------------------
+    -folders: sequence containing 'temp' and/or 'perm', default: ('temp', 'perm')
+
+    Returns
+    -------------------------------
+    -batches: dict mapping each batch name 'p{patient}_{date}_{shift}_{batch}' to a dict with its 'hdf5file' (output .h5)
+              and 'hours' (dict mapping each hour index to its .c3d file). If a batch is in both folders, the temporary one is used.
+
+    """
+    paths = {'temp': temp_path, 'perm': perm_path}
+    batches = {}
+    for folder in folders:
+        for c3d_file in sorted(paths[folder].glob('p*/*.c3d')):
+            match = c3d_pattern.match(c3d_file.name)
+            if match is None:
+                continue
+            patient, date, shift, batch, hour = match.groups()
+            name = f"p{patient}_{date}_{shift}_{batch}"
+            if name not in batches:
+                batches[name] = {'hdf5file': temp_path / f"p{patient}" / f"{name}.h5", 'hours': {}, 'folder': folder}
+            if batches[name]['folder'] == folder:
+                batches[name]['hours'][int(hour)] = c3d_file
+
+    return batches
+
+def load_manifest():
+    """
+    Loads the manifest, dict mapping each batch name to the list of hour keys (e.g. 'Hour3') already converted.
+    """
+    if not manifest_file.exists():
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    """
+    Saves the manifest atomically (a crash never leaves a truncated manifest).
+    """
+    tmp = manifest_file.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_file)
+
+def record_hour(name, i):
+    """
+    Records a converted hour in the manifest. The manifest is re-read, updated and saved under an exclusive lock, so
+    that schedulers converting different batches at the same time never erase each other's hours.
+
+    Returns
+    -------------------------------
+    -manifest: dict, the updated manifest.
+
+    """
+    with open(manifest_file.with_suffix('.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)    # released when the file is closed
+        manifest = load_manifest()
+        hours = manifest.setdefault(name, [])
+        if f"Hour{i}" not in hours:
+            hours.append(f"Hour{i}")
+        save_manifest(manifest)
+    return manifest
+
+def lock_batch(hdf5file):
+    """
+    Takes the lock of a batch, an exclusive flock on the .lock file next to its .h5 file. The kernel releases the lock
+    when the process exits, even if it is killed or crashes, so a leftover .lock file never blocks later runs: it is
+    simply locked again. The host and PID of the holder are written in the file for information.
+
+    Returns
+    -------------------------------
+    -lock: open lock file to pass to unlock_batch, or None if the batch is being converted by another running scheduler.
+
+    """
+    lock_file = hdf5file.with_suffix('.lock')
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        lock = open(lock_file, 'a+')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        # The previous holder may have removed the file between open and flock: lock the current file instead
+        try:
+            if os.stat(lock_file).st_ino == os.fstat(lock.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+    lock.seek(0)
+    lock.truncate()
+    lock.write(f"{socket.gethostname()} {os.getpid()}\n")
+    lock.flush()
+    return lock
+
+def unlock_batch(lock):
+    """
+    Removes the .lock file of a batch (see lock_batch) and releases it.
+    """
+    os.remove(lock.name)
+    lock.close()
+
+def pending_hours(batch, done):
+    """
+    Hours of a batch that still have to be converted: those missing from the manifest or from the .h5 file.
+    """
+    stored = set()
+    if batch['hdf5file'].exists():
+        with pd.HDFStore(batch['hdf5file'], mode='r') as store:
+            stored = {f"Hour{i}" for i in hourKeys(store)}
+    return [i for i in sorted(batch['hours']) if f"Hour{i}" not in done or f"Hour{i}" not in stored]
+
+def schedule(folders=('temp', 'perm'), workers=None, dry_run=False, layout='fixed'):
+    """
+    Converts every pending batch found under the temporary/permanent folders to HDF5 (see TSGv4), with at most
+    `workers` hours converted at the same time. Completed hours are recorded in the manifest after each write, so
+    that an interrupted run resumes where it stopped (partial .h5 files are completed, not rewritten). A lock file
+    next to each .h5 file prevents two schedulers from converting the same batch: a batch locked by another scheduler
+    is reported as in progress and skipped, without opening its .h5 file.
+
+    Args
+    -------------------------------
+    -folders: sequence containing 'temp' and/or 'perm', default: ('temp', 'perm')
+    -workers: int, maximum nb of hours converted in parallel, default: nb of CPUs
+    -dry_run: bool, whether to only list what would be processed, default: False
+    -layout: HDF5 layout of the converted hours, either 'fixed' or 'table' (see TSGv4.write_hour), default: 'fixed'
+
+    Returns
+    -------------------------------
+    -queue: dict mapping each pending batch name to the list of its pending hours.
+
+    """
+    start_timer = timer()
+
+    batches = find_batches(folders)
+
+    # Lock each batch before looking at its .h5 file (which may be open for writing by another scheduler), and only
+    # then list its pending hours, from the manifest as it is once the lock is taken
+    queue, locks, busy = {}, {}, []
+    for name, batch in batches.items():
+        lock = lock_batch(batch['hdf5file'])
+        if lock is None:
+            busy.append(name)
+            continue
+        hours = pending_hours(batch, set(load_manifest().get(name, [])))
+        if hours and not dry_run:
+            locks[name] = lock
+        else:
+            unlock_batch(lock)
+        if hours:
+            queue[name] = hours
+
+    print(f"{len(batches)} batches found, {len(queue)} pending, {len(busy)} in progress:")
+    for name, hours in queue.items():
+        print(f"-{name}: hours {hours} of {len(batches[name]['hours'])}")
+    for name in busy:
+        print(f"-{name}: in progress (being converted by another scheduler)")
+
+    if dry_run or not queue:
+        return queue
+
+    try:
+        workers = workers or os.cpu_count()
+        c3d_files = {(name, i): batches[name]['hours'][i] for name, hours in queue.items() for i in hours}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Single writer: hours are written (and recorded in the manifest) as soon as they are converted, with at
+            # most `workers` hours in memory whatever the size of the backlog (see TSGv4.convert_hours)
+            for done, ((name, i), (data, fs, elapsed)) in enumerate(convert_hours(pool, c3d_files, workers), start=1):
+                write_hour(batches[name]['hdf5file'], i, data, fs, layout)
+                del data
+
+                record_hour(name, i)
+
+                print(f"{name} Hour{i} ({done}/{len(c3d_files)} done): converted in {elapsed:.2f} s")
+    finally:
+        for lock in locks.values():
+            unlock_batch(lock)
+
+    elapsed = (timer() - start_timer) / 60
+    print(f'Code executed in {elapsed:.2f} minutes')
+
+    return queue
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Convert every pending batch to HDF5")
+    parser.add_argument('--folders', type=str, nargs='+', default=['temp', 'perm'], help="Folders to scan, temp and/or perm")
+    parser.add_argument('--workers', type=int, default=None, help="Maximum number of hours converted in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the batches and hours that would be processed")
+    parser.add_argument('--layout', type=str, default='fixed', help="HDF5 layout, fixed or table")
+
+    args = parser.parse_args()
+
+    schedule(args.folders, args.workers, args.dry_run, args.layout)
@@ -0,0 +1,186 @@
+import os
+import pathlib
+import numpy as np
+import pandas as pd
+import c3d
+from scipy.signal import sosfilt
+from load_data import C3D_ORDER, SIGNAL_DTYPE   # type: ignore
+from processing_tools import filterDesign       # type: ignore
+from TSGv3 import timestamps_ns                 # type: ignore
+from TSGv4 import write_hour                    # type: ignore
+
+# Nb of Cometa sensors, each with one EMG channel and a 3-axis accelerometer (analog channels 4k, 4k+1, 4k+2, 4k+3)
+N_SENSORS = 8
+
+# Nb of analog samples per C3D frame
+SAMPLES_PER_FRAME = 20
+
+def channelLabels():
+    """
+    Labels of the 32 analog channels in the order of the C3D file (sensor by sensor: EMG, ACM X, ACM Y, ACM Z).
+    """
+    return [f"EMG {k + 1}" if kind == 0 else f"ACM {k + 1} {'XYZ'[kind - 1]}" for k in range(N_SENSORS) for kind in range(4)]
+
+def syntheticHour(nsamples, fs=2000, seed=0, burst_rate=1, dtype=SIGNAL_DTYPE):
+    """
+    Generates a realistic synthetic recording with the layout of the Cometa system (8 EMG + 24 ACM channels, ordered as
+    returned by the readers, see load_data.C3D_ORDER):
+    -EMG (uV): baseline noise and 60 Hz interference, with bursts of muscle activity (20-450 Hz band-limited noise of
+     random amplitude and duration) at random times.
+    -ACM (g): gravity along a random orientation of each sensor and sensor noise, with low-frequency motion during the bursts.
+
+    Args:
+    -----------------------------------------------------------------
+    -nsamples: int, nb of samples.
+    -fs: sampling frequency (Hz), default: 2000
+    -seed: int, seed of the random generator, default: 0
+    -burst_rate: mean nb of bursts per minute, default: 1
+    -dtype: dtype of the channels, default: SIGNAL_DTYPE (float32)
+
+    Returns:
+    -----------------------------------------------------------------
+    -data: dataframe (samples x 32 channels) containing the synthetic data.
+
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(nsamples) / fs
+
+    # Bursts (shared by all sensors, with a different amplitude on each)
+    activity = np.zeros(nsamples)
+    for _ in range(rng.poisson(burst_rate * nsamples / fs / 60)):
+        start = rng.integers(nsamples)
+        duration = int(rng.uniform(0.5, 5) * fs)
+        activity[start:(start + duration)] = 1
+    gains = rng.uniform(50, 500, N_SENSORS)
+
+    emg = sosfilt(filterDesign('bandpass', (20, min(450, 0.45 * fs)), order=4, fs=fs), rng.standard_normal((nsamples, N_SENSORS)), axis=0)
+    emg *= activity[:, np.newaxis] * gains * 2
+    emg += 5 * rng.standard_normal((nsamples, N_SENSORS))
+    emg += 10 * np.sin(2 * np.pi * 60 * t + rng.uniform(0, 2 * np.pi, N_SENSORS)[:, np.newaxis]).T
+
+    orientation = rng.standard_normal((3, N_SENSORS))
+    orientation /= np.linalg.norm(orientation, axis=0)
+    motion = sosfilt(filterDesign('lowpass', 5, order=2, fs=fs), rng.standard_normal((nsamples, 3 * N_SENSORS)), axis=0)
+    acm = orientation.reshape(1, -1) + 0.005 * rng.standard_normal((nsamples, 3 * N_SENSORS))
+    acm += motion * activity[:, np.newaxis] * 10
+
+    columns = np.asarray(channelLabels())[C3D_ORDER]
+    return pd.DataFrame(np.hstack([emg, acm]).astype(dtype), columns=columns)
+
+def writeSyntheticC3D(file, data, fs=2000, time_stopped=None):
+    """
+    Writes synthetic data to a C3D file laid out as the Cometa exports: float analog blocks of SAMPLES_PER_FRAME samples
+    per frame (no point data), the channels interleaved sensor by sensor, and the last frame padded with zeros. The
+    modification time of the file is set to the time at which the recording stopped (used by TSG to generate the time-stamps).
+
+    Args:
+    -----------------------------------------------------------------
+    -file: path of the .c3d file.
+    -data: dataframe (samples x 32 channels) returned by syntheticHour.
+    -fs: sampling frequency (Hz), default: 2000
+    -time_stopped: Timestamp at which the recording stopped, default: None (keep the current time)
+
+    Returns:
+    -----------------------------------------------------------------
+    None
+
+    """
+    analog = data.to_numpy(dtype=np.float32)[:, np.argsort(C3D_ORDER)]
+    nframes = -(-len(analog) // SAMPLES_PER_FRAME)
+    blocks = np.zeros((nframes * SAMPLES_PER_FRAME, analog.shape[1]), dtype=np.float32)
+    blocks[:len(analog)] = analog
+    blocks = blocks.reshape(nframes, SAMPLES_PER_FRAME, -1).transpose(0, 2, 1)
+
+    writer = c3d.Writer(point_rate=fs / SAMPLES_PER_FRAME, analog_rate=fs, point_scale=-1.0)
+    writer.set_analog_labels(channelLabels())
+    points = np.zeros((0, 5), dtype=np.float32)
+    writer.add_frames([(points, block) for block in blocks])
+    with open(file, 'wb') as f:
+        writer.write(f)
+
+    if time_stopped is not None:
+        # The modification time is read back as a local date-time (datetime.fromtimestamp)
+        stopped = pd.Timestamp(time_stopped).to_pydatetime().timestamp()
+        os.utime(file, (stopped, stopped))
+
+    return None
+
+def writeSyntheticHDF5(file, hours=1, fs=2000, layout='fixed', seconds=3600, start='2024-01-01 22:00:00', seed=0):
+    """
+    Writes a synthetic batch (see syntheticHour) to an HDF5 file in the format of TSG: one 'Hour{i}' key per hour (or
+    the 'table' layout, see TSGv4.write_hour) with the 'sec' column and the int64 ns time-stamps as indexes.
+
+    Args:
+    -----------------------------------------------------------------
+    -file: path of the .h5 file (overwritten if it exists).
+    -hours: int, nb of hours in the batch, default: 1
+    -fs: sampling frequency (Hz), default: 2000
+    -layout: either 'fixed' or 'table', default: 'fixed'
+    -seconds: duration of each "hour" (s), shorter for quick tests, default: 3600
+    -start: time-stamp of the first sample of the batch, default: '2024-01-01 22:00:00'
+    -seed: int, seed of the random generator (hour i uses seed + i), default: 0
+
+    Returns:
+    -----------------------------------------------------------------
+    -start: Timestamp, time-stamp of the first sample of the batch.
+
+    """
+    file = pathlib.Path(file)
+    if file.exists():
+        file.unlink()
+
+    start = pd.Timestamp(start)
+    nsamples = int(seconds * fs)
+    for i in range(1, hours + 1):
+        data = syntheticHour(nsamples, fs, seed + i)
+        data.insert(0, 'sec', np.arange(nsamples) / fs)
+        data.index = timestamps_ns(start + pd.Timedelta(seconds=(i - 1) * seconds), nsamples, 1 / fs)
+        data.index.name = 'Time'
+        write_hour(file, i, data, fs, layout)
+
+    return start
+
+def writeSyntheticBatch(directory, patient=0, date=20240101, shift='N', batch=1, hours=1, fs=2000, seconds=3600,
+                        formats=('c3d', 'h5'), layout='fixed', start='2024-01-01 22:00:00', seed=0):
+    """
+    Writes a synthetic batch with the folder structure and file names of the real data, so that it can be read by
+    readC3D/readHDF5 (or TSG) with temp_path (or perm_path) pointing to directory:
+        directory/p{patient}/p{patient}_{date}_{shift}_{batch}_{i}.c3d   (one file per hour)
+        directory/p{patient}/p{patient}_{date}_{shift}_{batch}.h5        (whole batch)
+    Both formats contain the same data.
+
+    Args:
+    -----------------------------------------------------------------
+    -directory: root folder of the synthetic data.
+    -patient, date, shift, batch: recording identifiers used in the file names, default: 0, 20240101, 'N', 1
+    -hours: int, nb of hours in the batch, default: 1
+    -fs: sampling frequency (Hz), default: 2000
+    -seconds: duration of each "hour" (s), default: 3600
+    -formats: sequence containing 'c3d' and/or 'h5', default: ('c3d', 'h5')
+    -layout: HDF5 layout, either 'fixed' or 'table', default: 'fixed'
+    -start: time-stamp of the first sample of the batch, default: '2024-01-01 22:00:00'
+    -seed: int, seed of the random generator, default: 0
+
+    Returns:
+    -----------------------------------------------------------------
+    -files: dict mapping 'c3d' to the list of .c3d files and 'h5' to the .h5 file (for the requested formats).
+
+    """
+    dirpath = pathlib.Path(directory) / f"p{patient}"
+    dirpath.mkdir(parents=True, exist_ok=True)
+    name = f"p{patient}_{date}_{shift}_{batch}"
+
+    files = {}
+    if 'c3d' in formats:
+        files['c3d'] = []
+        nsamples = int(seconds * fs)
+        for i in range(1, hours + 1):
+            c3d_file = dirpath / f"{name}_{i}.c3d"
+            stopped = pd.Timestamp(start) + pd.Timedelta(seconds=(i - 1) * seconds + (nsamples - 1) / fs)
+            writeSyntheticC3D(c3d_file, syntheticHour(nsamples, fs, seed + i), fs, stopped)
+            files['c3d'].append(c3d_file)
+    if 'h5' in formats:
+        files['h5'] = dirpath / f"{name}.h5"
+        writeSyntheticHDF5(files['h5'], hours, fs, layout, seconds, start, seed)
+
+    return files